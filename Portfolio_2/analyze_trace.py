@@ -0,0 +1,139 @@
+import argparse
+import os
+
+import numpy as np
+
+import application1 as drtp
+
+# One trace record as written by EventTrace and EventRing: (monotonic time in ns, kind, sequence number, value),
+# big-endian and packed like EVENT_STRUCT
+RECORD_DTYPE = np.dtype([('time', '>u8'), ('kind', 'u1'), ('seq', '>u4'), ('value', '>u4')])
+
+# Width of the bins of the goodput and retransmission series, in seconds
+INTERVAL = 0.1
+
+# Function to load a trace file or a dumped event ring into an array of records ordered by time.
+# A trace whose process was killed can end in the middle of a record, that record is left out.
+def load_trace(path):
+    with open(path, 'rb') as f:
+        header = f.read(drtp.EVENT_HEADER.size)
+        if len(header) < drtp.EVENT_HEADER.size:
+            raise ValueError(f"{path} is too short to be a DRTP trace")
+        magic, size = drtp.EVENT_HEADER.unpack(header)
+        if magic != drtp.EVENT_MAGIC:
+            raise ValueError(f"{path} is not a DRTP trace")
+        if size != RECORD_DTYPE.itemsize:
+            raise ValueError(f"{path} has records of {size} bytes, this analyzer reads records of {RECORD_DTYPE.itemsize} bytes")
+        count = (os.path.getsize(path) - drtp.EVENT_HEADER.size) // size
+        records = np.fromfile(f, dtype=RECORD_DTYPE, count=count)
+    # Threads of a multi-client server write one trace, so records can be slightly out of order
+    return records[np.argsort(records['time'], kind='stable')]
+
+# Function to write columns as a CSV file with a header line, fmt gives the format of every column
+def write_csv(path, header, columns, fmt):
+    np.savetxt(path, np.rec.fromarrays(columns), fmt=fmt, delimiter=',', header=header, comments='')
+    print(f"Wrote {len(columns[0])} rows to {path}")
+
+# Sequence number against time of every data packet and ACK sent or received
+def seq_series(times, records):
+    kinds = [drtp.EVENT_SEND, drtp.EVENT_RESEND, drtp.EVENT_FAST_RETRANSMIT, drtp.EVENT_ACK, drtp.EVENT_RECEIVE, drtp.EVENT_SEND_ACK]
+    mask = np.isin(records['kind'], kinds)
+    names = np.array(drtp.EVENT_NAMES)[records['kind'][mask]]
+    return [times[mask], records['seq'][mask], names]
+
+# Packets delivered in every bin. A receiver trace counts the first arrival of every sequence number. A sender
+# trace counts how far the highest ACK has moved since the first ACK in the trace, which is not packet 1 in a
+# dumped ring: exact for cumulative ACKs, ahead of the receiver while a Selective Repeat sender still has holes.
+def delivered_per_bin(times, records, edges):
+    received = records['kind'] == drtp.EVENT_RECEIVE
+    if received.any():
+        _, first = np.unique(records['seq'][received], return_index=True)
+        return np.histogram(times[received][first], bins=edges)[0]
+    acked = records['kind'] == drtp.EVENT_ACK
+    if not acked.any():
+        return np.zeros(len(edges) - 1, dtype=np.int64)
+    highest = np.maximum.accumulate(records['seq'][acked].astype(np.int64))
+    last = np.searchsorted(times[acked], edges[1:], side='right') - 1  # Last ACK before the end of every bin
+    level = np.where(last >= 0, highest[np.maximum(last, 0)], highest[0] - 1)
+    return np.diff(level, prepend=highest[0] - 1)
+
+# Goodput of every bin in Mbps, from the packets delivered in it
+def goodput_series(times, records, edges, interval):
+    delivered = delivered_per_bin(times, records, edges)
+    goodput = delivered * drtp.PACKET_DATA_SIZE * 8 / interval / 1000000
+    return [edges[1:], delivered, goodput]
+
+# RTT samples the sender took, Karn's algorithm already left out the retransmitted packets
+def rtt_series(times, records):
+    mask = records['kind'] == drtp.EVENT_RTT
+    return [times[mask], records['seq'][mask], records['value'][mask] / 1000]
+
+# Packets sent for the first time, packets sent again and timeouts in every bin, and the share of the packets
+# sent in the bin that were retransmissions
+def retransmission_series(times, records, edges):
+    kinds = records['kind']
+    sent = np.histogram(times[kinds == drtp.EVENT_SEND], bins=edges)[0]
+    resent = np.histogram(times[np.isin(kinds, [drtp.EVENT_RESEND, drtp.EVENT_FAST_RETRANSMIT])], bins=edges)[0]
+    timeouts = np.histogram(times[kinds == drtp.EVENT_TIMEOUT], bins=edges)[0]
+    total = sent + resent
+    rate = np.divide(resent, total, out=np.zeros(len(total)), where=total > 0)
+    return [edges[1:], sent, resent, timeouts, rate]
+
+# Congestion window after every change, with the base of the window when it changed
+def window_series(times, records):
+    mask = records['kind'] == drtp.EVENT_WINDOW
+    return [times[mask], records['seq'][mask], records['value'][mask]]
+
+# Function to print the totals of a trace
+def print_summary(path, times, records, goodput, rtt, retransmissions):
+    duration = times[-1] if len(times) else 0.0
+    print(f"{path}: {len(records)} events over {duration:.3f} s")
+    counts = np.bincount(records['kind'], minlength=len(drtp.EVENT_NAMES))
+    print('Events: ' + ', '.join(f'{count} {name}' for name, count in zip(drtp.EVENT_NAMES, counts)))
+    delivered = goodput[1].sum()
+    if duration:
+        print(f"Goodput: {delivered} packets, {delivered * drtp.PACKET_DATA_SIZE * 8 / duration / 1000000:.2f} Mbps on average")
+    if len(rtt[2]):
+        print(f"RTT: median {np.median(rtt[2]):.2f} ms, 95th percentile {np.percentile(rtt[2], 95):.2f} ms, "
+              f"max {rtt[2].max():.2f} ms over {len(rtt[2])} samples")
+    sent, resent = retransmissions[1].sum(), retransmissions[2].sum()
+    if sent + resent:
+        print(f"Retransmissions: {resent} of {sent + resent} packets sent ({resent / (sent + resent) * 100:.1f} %), "
+              f"{retransmissions[3].sum()} timeouts")
+
+def main():
+    # Create a command-line argument parser
+    parser = argparse.ArgumentParser(description='Turn a DRTP trace (--trace) or event dump (--events) into CSV series')
+    parser.add_argument('trace', type=str, help='Trace or event dump to analyze')
+    parser.add_argument('-o', type=str, help='Prefix of the CSV files (default: the trace name without its extension)')
+    parser.add_argument('--interval', type=float, default=INTERVAL, help='Width of the goodput and retransmission bins in seconds')
+    args = parser.parse_args()
+
+    if args.interval <= 0:
+        parser.error("The interval must be positive")
+    try:
+        records = load_trace(args.trace)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    # Times in seconds from the first record, and bins covering all of them
+    times = (records['time'] - records['time'][0]) / 1e9 if len(records) else np.zeros(0)
+    duration = times[-1] if len(times) else 0.0
+    edges = np.arange(0, duration + args.interval, args.interval)
+    if len(edges) < 2:
+        edges = np.array([0, args.interval])
+
+    prefix = args.o or os.path.splitext(args.trace)[0]
+    goodput = goodput_series(times, records, edges, args.interval)
+    rtt = rtt_series(times, records)
+    retransmissions = retransmission_series(times, records, edges)
+    write_csv(f'{prefix}_seq.csv', 'time_s,seq,event', seq_series(times, records), ['%.6f', '%d', '%s'])
+    write_csv(f'{prefix}_goodput.csv', 'time_s,packets,goodput_mbps', goodput, ['%.3f', '%d', '%.3f'])
+    write_csv(f'{prefix}_rtt.csv', 'time_s,seq,rtt_ms', rtt, ['%.6f', '%d', '%.3f'])
+    write_csv(f'{prefix}_retransmissions.csv', 'time_s,sent,resent,timeouts,retransmission_rate', retransmissions,
+              ['%.3f', '%d', '%d', '%d', '%.4f'])
+    write_csv(f'{prefix}_window.csv', 'time_s,base,window', window_series(times, records), ['%.6f', '%d', '%d'])
+    print_summary(args.trace, times, records, goodput, rtt, retransmissions)
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,27 @@
 import argparse
+import asyncio
+import bisect
+import hashlib
+import heapq
+import lzma
+import mmap
+import multiprocessing
+import os
+import queue
+import random
+import shutil
+import signal
 import socket
 import struct
+import tempfile
+import threading
 import time
+import zlib
 import logging
 from struct import *
 
+from drtp_codec import HEADER_SIZE, Packet, pack_header, pack_header_into, unpack_header
+
 # Set up logging to display information level logs and above with a specific format
 logging.basicConfig(level=logging.INFO, format='%(message)s')
 
@@ -15,17 +32,139 @@ FIN = 0b0010  # Finish flag
 RST = 0b0001  # Reset flag
 WINDOW_SIZE = 0 # Size of the window for flow control
 #TIMEOUT = 2.0  # Timeout period for receiving packets
+DEFAULT_WINDOW = 15  # Number of data packets in flight with a fixed window
+MAX_WINDOW = 64  # Largest congestion window the senders allow, in packets
 
-# Define the format of the DRTP header
-HEADER_FORMAT = '!IIHH'
+# The DRTP header format, its precompiled codec and its size come from drtp_codec
 
 # Define the size of the data part of a DRTP packet, in bytes
 PACKET_DATA_SIZE = 1460  
 
-# Function to parse a DRTP header from a string
-def parse_header(header):
-    header_from_msg = unpack(HEADER_FORMAT, header)
-    return header_from_msg
+# Largest DRTP packet, header plus a full data part
+MAX_PACKET_SIZE = HEADER_SIZE + PACKET_DATA_SIZE
+
+# Retransmission timeout limits, in seconds. Until the first RTT sample the senders use the old fixed 500 ms.
+INITIAL_RTO = 0.5
+MIN_RTO = 0.01
+MAX_RTO = 8.0
+# Least margin of the RTO over the smoothed RTT (G in RFC 6298). A paced flow sees an almost constant RTT, so
+# 4 * rttvar falls towards 0 and a scheduling hiccup of a few ms would fire the timers of a whole window.
+RTO_GRANULARITY = 0.01
+
+# Time a receiver waits for the next packet before it gives the transfer up, longer than any RTO so a sender
+# that has backed off is not taken for one that has gone away
+IDLE_TIMEOUT = 2 * MAX_RTO
+
+# Options negotiated in the payload of the SYN and SYN-ACK packets. The client sends the options it wants,
+# the server answers with the ones it also supports. A peer that knows no options sends and ignores an
+# empty payload, so an option is only used when both peers agreed on it.
+OPTIONS_STRUCT = struct.Struct('!H')
+OPTION_SACK = 0b0001  # ACKs carry a cumulative ACK and a selective-ACK bitmap
+OPTION_RANGE = 0b0010  # The flow carries one byte range of a parallel transfer, only a server started with -P accepts it
+OPTION_CHECKSUM = 0b1000  # Data packets carry a CRC32 and the FIN a digest of the file, only the blocking engine checks them
+OPTION_COMPRESS = 0b10000  # The data is a stream of compressed blocks, only the blocking engine decompresses it
+CRC_STRUCT = struct.Struct('!IH')  # Sequence number and flags of a packet, covered by its CRC with the payload
+SUPPORTED_OPTIONS = OPTION_SACK
+
+# Metadata packet, the first packet after the handshake (sequence number 0): the size of the whole file, the
+# packet size and the number of data packets that follow, then the UTF-8 name of the file. The sender resends it
+# every INITIAL_RTO until it is acknowledged, at most METADATA_RETRIES times. GBN and SR acknowledge it with ACK 0,
+# stop-and-wait with ACK 1 (the next packet expected), so its ACK is never taken for the ACK of packet 1.
+META_STRUCT = struct.Struct('!QHI')
+METADATA_RETRIES = 10
+
+# Receivers report their progress at most every PROGRESS_INTERVAL seconds
+PROGRESS_INTERVAL = 1.0
+
+# Per-packet events. Every send, ACK, retransmission and timeout is counted, printed unless the program runs
+# quietly (-q), with --events kept in a ring of the last records and with --trace appended to a file. A record is
+# (monotonic time in ns, kind, sequence number, value), the value is the new window of a window change, the
+# sample in microseconds of an RTT sample and 0 for the other kinds.
+EVENT_SEND = 0
+EVENT_RESEND = 1
+EVENT_FAST_RETRANSMIT = 2
+EVENT_TIMEOUT = 3
+EVENT_ACK = 4
+EVENT_RECEIVE = 5
+EVENT_SEND_ACK = 6
+EVENT_DROP = 7
+EVENT_WINDOW = 8
+EVENT_RTT = 9
+EVENT_NAMES = ['sent', 'resent', 'fast retransmitted', 'timeouts', 'acks received', 'received', 'acks sent', 'dropped',
+               'window changes', 'RTT samples']
+EVENT_STRUCT = struct.Struct('!QBII')
+EVENT_MAGIC = b'DRTE'  # Start of a dumped ring or a trace file, followed by the record size
+EVENT_HEADER = struct.Struct('!4sH')
+TRACE_BUFFER = 1024 * 1024  # Write buffer of the trace file, records reach the disk in writes of this size
+
+# Byte range of a parallel transfer, sent after the options in the SYN: the start of the range in the
+# file and the size of the whole file. The range ends where the sender's FIN says it does.
+RANGE_STRUCT = struct.Struct('!QQ')
+
+# Resumable transfers. The SYN carries the file size and modification time (ns) after the options (and after
+# the byte range), followed by the file name. The SYN-ACK answers with the number of missing ranges and (first, last) packet of
+# each, at most MAX_RESUME_RANGES so the answer fits in one packet; the last range then runs to the end.
+OPTION_RESUME = 0b0100  # Only a server started with --resume accepts it
+RESUME_STRUCT = struct.Struct('!QQ')
+RESUME_COUNT_STRUCT = struct.Struct('!H')
+RESUME_RANGE_STRUCT = struct.Struct('!II')
+MAX_RESUME_RANGES = 128
+
+# Saved receive state of a resumable transfer, <output file>.resume: a header with a magic number, the file
+# size, the packet size, the modification time of the sender's file and the length of its name, then the name,
+# then a bitmap where bit i is set once packet i + 1 has been written.
+# The receiver saves it every RESUME_SAVE_INTERVAL seconds and when the transfer ends or fails.
+RESUME_HEADER = struct.Struct('!4sQIQH')
+RESUME_MAGIC = b'DRTR'
+RESUME_SAVE_INTERVAL = 1.0
+
+# Compression. The sender cuts the file into COMPRESS_BLOCK byte blocks and sends a stream of blocks, each one a
+# BLOCK_STRUCT header (method, length) and the block, compressed if that made it COMPRESS_RATIO of its size or
+# smaller and raw otherwise. After a poor block the next 1, 2, 4, ... COMPRESS_BACKOFF blocks are sent raw without
+# trying, so already compressed files cost little CPU. Every block is compressed on its own.
+COMPRESS_BLOCK = 64 * 1024
+COMPRESS_RATIO = 0.9
+COMPRESS_BACKOFF = 16
+BLOCK_STRUCT = struct.Struct('!BI')
+BLOCK_RAW = 0
+BLOCK_ZLIB = 1
+BLOCK_LZMA = 2
+COMPRESSORS = {'zlib': (BLOCK_ZLIB, zlib.compress), 'lzma': (BLOCK_LZMA, lzma.compress)}
+DECOMPRESSORS = {BLOCK_RAW: None, BLOCK_ZLIB: zlib.decompressobj, BLOCK_LZMA: lzma.LZMADecompressor}
+
+# SACK extension sent as the payload of ACK packets: the cumulative ACK (last packet received in order)
+# and a bitmap where bit i is set when packet cumulative + 1 + i has been received
+SACK_STRUCT = struct.Struct('!IQ')
+SACK_BITS = 64  # Packets covered by the bitmap, at least the largest window
+
+# Number of duplicate cumulative ACKs that trigger a fast retransmit in Go-Back-N
+DUP_ACK_THRESHOLD = 3
+
+# Delayed ACKs: by default every data packet is acknowledged at once, a held back ACK is sent after ACK_DELAY seconds
+ACK_EVERY = 1
+ACK_DELAY = 0.005
+
+# Pacing: the estimated rate is PACING_GAIN windows per smoothed RTT, so pacing spreads a window out without
+# holding the window back, PACING_SS_GAIN in slow start where the window doubles every RTT,
+# and the token bucket lets PACING_BURST packets go out back-to-back
+PACING_GAIN = 1.25
+PACING_SS_GAIN = 2.0
+PACING_BURST = 2
+SPIN_TIME = 0.0002  # time.sleep can oversleep by tens of microseconds, so the last part of a wait spins
+PACING_SLEEP = 0.001  # Shorter gaps between new packets are slept through, longer ones are spent reading ACKs
+
+# The senders drop the mapped pages of acknowledged packets in steps of this many bytes, so sender memory
+# does not grow with the file. madvise is not available on every platform.
+RELEASE_STEP = 1024 * 1024
+HAVE_MADVISE = hasattr(mmap, 'MADV_DONTNEED')
+
+# Scatter-gather sends are not available on every platform
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+# Link impairment of -t: outgoing data packets and ACKs can be dropped, burst-dropped, duplicated, reordered
+# and delayed. Decisions come from a seeded generator, so a run sees the same losses every time it is repeated.
+IMPAIR_SEED = 1
+REORDER_HOLD = 0.01  # Time a reordered datagram is held back when the spec does not say, in seconds
 
 # Function to parse the flags from a flags field
 def parse_flags(flags):
@@ -34,55 +173,947 @@ def parse_flags(flags):
     fin = flags & (1 << 1)  # FIN flag is the 2nd bit from the right
     return syn, ack, fin
 
-def send_packet(sock, packet, address):
-    packet_header = struct.pack(HEADER_FORMAT, packet['seq'], packet['ack'], packet['flags'], packet['window'])
-    sock.sendto(packet_header + packet['data'], address)
-
-# Function to receive a DRTP packet from a socket
-def receive_packet(sock):
-    try:
-        data, address = sock.recvfrom(1472)  # Maximum DRTP packet size is 1472 bytes
-    except socket.timeout:
-        logging.warning("Socket timeout occurred. Ignoring this packet.")
-        return None, None
-    
-    data_len = len(data)
-    if data_len < 12:  # If the packet is smaller than the header size, it's invalid
-        logging.warning("Received data is less than 12 bytes. Ignoring this packet.")
-        packet = None
-    else: 
-        packet_header = struct.unpack(HEADER_FORMAT, data[:12])  # Unpack the header from the first 12 bytes of the packet
-        packet = {'seq': packet_header[0], 'ack': packet_header[1], 'flags': packet_header[2], 'window': packet_header[3], 'data': data[12:]}
-        logging.info(f"Received packet with seq {packet['seq']}")  # Log the sequence number of the received packet
-    return packet, address
-
 # Function to create a DRTP packet from sequence number, acknowledgment number, flags, window size and data
 def create_packet(seq, ack, flags, win, data):
-    header = pack (HEADER_FORMAT, seq, ack, flags, win)
+    header = pack_header(seq, ack, flags, win)
     packet = header + data
     """Create a DRTP packet"""
     #return {'seq': seq, 'ack': ack, 'flags': flags, 'window': window, 'data': data}
     return packet
 
-# Function to send an ACK packet
-def send_ack(sock, address, seq):
-    # Create an ACK packet with the received sequence number
-    packet = create_packet(0, seq, ACK, WINDOW_SIZE, b'')
-    # Log the sequence number of the ACK packet
-    logging.info(f"Sent ack for seq: {seq}")
-    # Send the ACK packet
-    send_packet(sock, packet, address)
-
-# Function to receive an ACK packet and check if it acknowledges the sent packet
-def receive_ack(sock, seq):
-    # Receive a packet
-    packet, _ = receive_packet(sock)
-    # If the received packet is an ACK packet for the sent packet
-    if packet and packet['ack'] == seq:
-        # Log the sequence number of the acknowledged packet
-        logging.info(f"Received final ACK for packet: {seq}")  
-    # Return True if the received packet is an ACK for the sent packet, False otherwise
-    return packet and packet['ack'] == seq
+# End-to-end integrity checks of one transfer, used when both peers agreed on OPTION_CHECKSUM.
+# Data packets carry a CRC32 of their sequence number, flags and payload in the first header field, which is
+# unused in data packets, so the check adds no bytes to the packet. A packet whose CRC does not match is dropped
+# like a lost packet, also when the corruption hit its number and it would otherwise be written at the wrong
+# offset. The window field is 0 in data packets and is not covered.
+# Both peers also hash the payloads in sequence order, the sender as it first sends them and the receiver as it
+# writes them, and the sender's FIN carries its digest for the receiver to compare.
+# zlib and hashlib read memoryviews directly, so neither check copies a payload.
+class Checksum:
+    def __init__(self):
+        self.digest = hashlib.sha256()
+        self.errors = 0  # Packets dropped because their CRC did not match
+        self.matched = None  # Whether the digest matched the sender's, None until the FIN has been checked
+
+    # CRC of a packet: its sequence number and flags, then its payload
+    def crc(self, seq, flags, data):
+        return zlib.crc32(data, zlib.crc32(CRC_STRUCT.pack(seq, flags)))
+
+    # Check the CRC of a received packet
+    def valid(self, crc, seq, flags, data):
+        if self.crc(seq, flags, data) == crc:
+            return True
+        self.errors += 1
+        return False
+
+    # Add the next payload in sequence order to the digest
+    def update(self, data):
+        self.digest.update(data)
+
+    # Payload of the sender's FIN packet
+    def fin_payload(self):
+        return self.digest.digest()
+
+    # Compare the digest of the written file with the one in the sender's FIN, returns True if they match
+    def verify(self, fin_payload):
+        matches = self.digest.digest() == fin_payload
+        self.matched = matches
+        print(f"File digest {self.digest.hexdigest()[:16]}: {'matches the sender' if matches else 'DOES NOT MATCH the sender, the file is corrupt'}")
+        print(f"Checksums: {self.errors} corrupted packets dropped")
+        return matches
+
+# Function to create the FIN packet that ends the data of a transfer, with the sender's digest when checksums are on.
+# Without checksums the payload is empty and the CRC field is 0, the same packet as before checksums existed.
+def create_fin(seq_num, checksum=None):
+    if not checksum:
+        return create_packet(0, seq_num, FIN, 0, b'')
+    data = checksum.fin_payload()
+    return create_packet(checksum.crc(seq_num, FIN, data), seq_num, FIN, 0, data)
+
+# Fixed-size ring of event records. A record is a tuple in a preallocated list of slots, adding one replaces the
+# oldest, so recording is a clock read, one tuple and one list store, and it takes no lock; server threads may
+# race on the count and lose a record. The records are only packed to EVENT_STRUCT when dumped.
+class EventRing:
+    def __init__(self, size):
+        self.size = size
+        self.slots = [None] * size
+        self.count = 0  # Records added so far, the next one goes to slot count % size
+        self.clock = time.monotonic_ns
+
+    def add(self, kind, seq, value):
+        count = self.count
+        self.slots[count % self.size] = (self.clock(), kind, seq, value)
+        self.count = count + 1
+
+    # The records in the ring, oldest first, packed like EVENT_STRUCT
+    def records(self):
+        if self.count <= self.size:
+            ordered = self.slots[:self.count]
+        else:
+            split = self.count % self.size
+            ordered = self.slots[split:] + self.slots[:split]
+        pack = EVENT_STRUCT.pack
+        return b''.join(pack(*record) for record in ordered)
+
+    # Write the records to a file, after a header with the record size
+    def dump(self, path):
+        records = self.records()
+        with open(path, 'wb') as f:
+            f.write(EVENT_HEADER.pack(EVENT_MAGIC, EVENT_STRUCT.size))
+            f.write(records)
+        print(f"Dumped {len(records) // EVENT_STRUCT.size} of {self.count} events to {path}")
+
+# Binary trace of every event, appended to a file through a buffered writer. The file has the header and the
+# records of a dumped ring, so analyze_trace.py reads both. The header is flushed at once so a process forked
+# later does not inherit it in the buffer and write it again.
+class EventTrace:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb', buffering=TRACE_BUFFER)
+        self.file.write(EVENT_HEADER.pack(EVENT_MAGIC, EVENT_STRUCT.size))
+        self.file.flush()
+        self.write = self.file.write
+        self.pack = EVENT_STRUCT.pack
+        self.clock = time.monotonic_ns
+        self.count = 0  # Records written so far
+
+    def add(self, kind, seq, value):
+        self.write(self.pack(self.clock(), kind, seq, value))
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+        print(f"Traced {self.count} events to {self.path}")
+
+# Event counters of the process, the ring when --events is given, the trace when --trace is given, and whether
+# events are printed
+class EventLog:
+    def __init__(self):
+        self.verbose = True
+        self.counts = [0] * len(EVENT_NAMES)
+        self.ring = None
+        self.trace = None
+
+    def summary(self):
+        return 'Events: ' + ', '.join(f'{count} {name}' for name, count in zip(EVENT_NAMES, self.counts))
+
+EVENTS = EventLog()
+
+# Function to set the event log of this process up from the command line: quiet or not, a fresh ring, and a
+# trace written to trace_path
+def setup_events(args, trace_path=None):
+    EVENTS.verbose = not args.q
+    EVENTS.ring = EventRing(args.events) if args.events else None
+    EVENTS.trace = EventTrace(trace_path) if trace_path else None
+
+# Function to dump the ring and close the trace of this process, ring_path is where the ring goes
+def finish_events(ring_path):
+    if EVENTS.ring is not None:
+        EVENTS.ring.dump(ring_path)
+    if EVENTS.trace is not None:
+        EVENTS.trace.close()
+        EVENTS.trace = None
+
+# Function to record a per-packet event. message is a format string for the sequence number, only formatted and
+# printed when not quiet, so the quiet path is a counter increment and at most one record packed into the ring
+# and one written to the trace.
+def event(kind, seq, message=None, value=0):
+    EVENTS.counts[kind] += 1
+    if EVENTS.ring is not None:
+        EVENTS.ring.add(kind, seq, value)
+    if EVENTS.trace is not None:
+        EVENTS.trace.add(kind, seq, value)
+    if EVENTS.verbose and message:
+        print(message.format(seq))
+
+# Description of a transfer, sent in the metadata packet
+class Metadata:
+    def __init__(self, name, size, chunks, chunk_size=PACKET_DATA_SIZE):
+        self.name = os.path.basename(name)  # The receiver never sees the sender's directories
+        self.size = size  # Size of the whole file
+        self.chunks = chunks  # Number of data packets in this transfer
+        self.chunk_size = chunk_size
+
+    def pack(self):
+        return META_STRUCT.pack(self.size, self.chunk_size, self.chunks) + self.name.encode()
+
+    def __str__(self):
+        return f'{self.name}: {self.size} bytes in {self.chunks} packets of {self.chunk_size} bytes'
+
+# Function to parse the payload of a metadata packet, returns None if it is not one
+def parse_metadata(data):
+    if len(data) < META_STRUCT.size:
+        return None
+    size, chunk_size, chunks = META_STRUCT.unpack_from(data)
+    try:
+        name = str(data[META_STRUCT.size:], 'utf-8')
+    except UnicodeDecodeError:
+        return None
+    return Metadata(name, size, chunks, chunk_size)
+
+# Function to choose the output file of a transfer: the prefix and the extension of the sender's file name,
+# or the sender's file name itself when the prefix is None (the server runs with --keep-name)
+def output_name(prefix, name):
+    name = os.path.basename(name)
+    if prefix is None:
+        return name if name not in ('', '.', '..') else 'received_file'
+    return f'{prefix}.{name.split(".")[-1]}'
+
+# Number in the ACK of the metadata packet
+def metadata_ack(protocol):
+    return 1 if protocol == 'stop_and_wait' else 0
+
+# Progress of a receiver: packets written out of the number in the metadata, the rate so far and the time left
+class Progress:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.done = 0
+        self.start_time = time.monotonic()
+        self.reported = self.start_time
+
+    # One more packet written
+    def update(self):
+        self.done += 1
+        now = time.monotonic()
+        if now - self.reported >= PROGRESS_INTERVAL and self.done < self.chunks:
+            self.reported = now
+            rate = self.done / (now - self.start_time)  # Packets per second
+            print(f"Progress: {self.done} of {self.chunks} packets ({self.done / self.chunks * 100:.1f}%), "
+                  f"{round(rate * PACKET_DATA_SIZE * 8 / 1000000, 2)} Mbps, ETA {(self.chunks - self.done) / rate:.1f} s")
+
+# Preallocated ring of DRTP headers used on the send path.
+# Each slot is a reusable 12-byte buffer and the header for sequence number N lives in slot N % slots,
+# so a retransmission reuses the header that is already packed. The header and the payload are handed
+# to the kernel together with scatter-gather sendmsg, so the payload is never copied into a new packet.
+class SendRing:
+    def __init__(self, slots, checksum=None):
+        self.slots = slots
+        self.checksum = checksum  # Puts the CRC32 of the payload in the header when checksums are on
+        self.buffer = bytearray(slots * HEADER_SIZE)  # One contiguous buffer for all headers
+        view = memoryview(self.buffer)
+        self.headers = [view[i * HEADER_SIZE:(i + 1) * HEADER_SIZE] for i in range(slots)]
+
+    # Pack the header of data packet seq_num into its slot and send it with the payload, returns the bytes sent
+    def send(self, sock, seq_num, data, address, flags=0):
+        header = self.headers[seq_num % self.slots]
+        crc = self.checksum.crc(seq_num, flags, data) if self.checksum else 0
+        pack_header_into(header, 0, crc, seq_num, flags, 0)  # Data packets carry their number in the second field
+        return send_segments(sock, header, data, address)
+
+    # Send the header already packed for seq_num again with the payload, returns the bytes sent
+    def resend(self, sock, seq_num, data, address):
+        return send_segments(sock, self.headers[seq_num % self.slots], data, address)
+
+# Function to send a header and a payload as one datagram without joining them first
+def send_segments(sock, header, data, address):
+    if HAVE_SENDMSG:
+        return sock.sendmsg([header, data], [], 0, address)
+    # Platforms without sendmsg (Windows) fall back to a single joined buffer
+    return sock.sendto(bytes(header) + data, address)
+
+# Read-only memory-mapped view of the file being sent.
+# Payload N is the slice at offset (N-1) * PACKET_DATA_SIZE, so the senders never call read() in the
+# window loop and a retransmission slices the mapping again instead of keeping a copy of the packet.
+# Pages are loaded on demand by the kernel and can be dropped again, so memory use stays flat for large files.
+class FileSource:
+    def __init__(self, file_name, start=0, length=None, ranges=None):
+        self.file = open(file_name, 'rb')
+        file_size = os.fstat(self.file.fileno()).st_size
+        # Only the bytes from start to start + length are sent, the whole file by default
+        self.size = file_size - start if length is None else length
+        # Number of data packets needed for the range
+        self.chunks = (self.size + PACKET_DATA_SIZE - 1) // PACKET_DATA_SIZE
+        if self.size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.map)[start:start + self.size]
+        else:
+            # An empty file cannot be mapped
+            self.map = None
+            self.view = memoryview(b'')
+        self.start = start
+        self.released = start // mmap.PAGESIZE * mmap.PAGESIZE  # Mapped bytes before this have been dropped
+
+        # A resumed transfer sends only the packets in ranges, numbered 1, 2, ... on the wire
+        self.packets = None
+        if ranges is not None:
+            self.packets = PacketMap(ranges)
+            self.chunks = self.packets.count
+
+    # Return the payload of data packet seq_num (numbered from 1) as a memoryview of the mapping
+    def payload(self, seq_num):
+        if self.packets:
+            seq_num = self.packets.packet(seq_num)
+        offset = (seq_num - 1) * PACKET_DATA_SIZE
+        return self.view[offset:offset + PACKET_DATA_SIZE]
+
+    # Drop the mapped pages of the packets before seq_num, they are acknowledged and never read again.
+    # The pages stay in the page cache, but no longer count towards the memory of the sender.
+    def release(self, seq_num):
+        if self.packets:
+            if seq_num > self.chunks:
+                return
+            seq_num = self.packets.packet(seq_num)
+        end = (self.start + (seq_num - 1) * PACKET_DATA_SIZE) // mmap.PAGESIZE * mmap.PAGESIZE
+        if HAVE_MADVISE and self.map is not None and end - self.released >= RELEASE_STEP:
+            self.map.madvise(mmap.MADV_DONTNEED, self.released, end - self.released)
+            self.released = end
+
+    # Size of data packet seq_num on the wire
+    def packet_size(self, seq_num):
+        if self.packets:
+            seq_num = self.packets.packet(seq_num)
+        return HEADER_SIZE + min(PACKET_DATA_SIZE, self.size - (seq_num - 1) * PACKET_DATA_SIZE)
+
+    def close(self):
+        self.view.release()
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Numbering of the packets a resumed transfer sends. ranges lists the (first, last) packets of the file that are
+# missing, and the packets in them are numbered 1, 2, ... on the wire, so the protocols see an ordinary transfer.
+class PacketMap:
+    def __init__(self, ranges):
+        self.ranges = ranges
+        self.wire_starts = []  # Wire sequence number of the first packet of every range
+        self.count = 0  # Number of packets in the ranges
+        for first, last in ranges:
+            self.wire_starts.append(self.count + 1)
+            self.count += last - first + 1
+
+    # Packet of the file that wire sequence number seq_num carries
+    def packet(self, seq_num):
+        i = bisect.bisect_right(self.wire_starts, seq_num) - 1
+        return self.ranges[i][0] + seq_num - self.wire_starts[i]
+
+# Function to list the (first, last) ranges of packets that are not set in a received-packet bitmap.
+# With more than limit ranges, the last one runs to the end of the file and covers some received packets too.
+def missing_ranges(bitmap, chunks, limit=MAX_RESUME_RANGES):
+    ranges = []
+    first = None  # First packet of the range being collected
+    for index, byte in enumerate(bitmap):
+        if byte == 0xFF or (byte == 0 and first is not None):
+            if byte == 0xFF and first is not None:
+                ranges.append((first, index * 8))
+                first = None
+            continue  # A whole byte received, or a whole byte inside a missing range
+        for bit in range(8):
+            seq_num = index * 8 + bit + 1
+            if seq_num > chunks:
+                break
+            if byte >> bit & 1:
+                if first is not None:
+                    ranges.append((first, seq_num - 1))
+                    first = None
+            elif first is None:
+                first = seq_num
+    if first is not None:
+        ranges.append((first, chunks))
+    if len(ranges) > limit:
+        ranges[limit - 1:] = [(ranges[limit - 1][0], chunks)]
+    return ranges
+
+# Output file of a resumable transfer, used by the receivers in place of the file object they would open.
+# Packets arrive numbered by the PacketMap of the missing ranges, in the order the receivers write them,
+# and each one is written at its own offset and set in the bitmap, which is saved next to the file.
+class ResumeFile:
+    def __init__(self, filename, file_size, source_name, mtime):
+        self.filename = filename
+        self.state_name = f'{filename}.resume'
+        self.file_size = file_size
+        self.source = source_name.encode()  # Name and modification time of the sender's file
+        self.mtime = mtime
+        self.chunks = (file_size + PACKET_DATA_SIZE - 1) // PACKET_DATA_SIZE
+        self.bitmap = bytearray((self.chunks + 7) // 8)
+
+        # Keep the saved state only if it belongs to the same version of the same file and the partial file is
+        # still there. Another file of the same size, or the same file changed since, is received from the start.
+        fresh = True
+        try:
+            with open(self.state_name, 'rb') as f:
+                state = f.read()
+            magic, size, packet_size, saved_mtime, name_length = RESUME_HEADER.unpack_from(state)
+            name = state[RESUME_HEADER.size:RESUME_HEADER.size + name_length]
+            if (magic, size, packet_size, saved_mtime, name) == (RESUME_MAGIC, file_size, PACKET_DATA_SIZE, mtime, self.source) \
+                    and len(state) == RESUME_HEADER.size + name_length + len(self.bitmap) and os.path.getsize(filename) == file_size:
+                self.bitmap[:] = state[RESUME_HEADER.size + name_length:]
+                fresh = False
+            else:
+                print(f"The saved state in {self.state_name} belongs to another file, receiving the whole file")
+        except (OSError, struct.error):
+            pass  # No usable state, receive the whole file
+
+        self.fd = os.open(filename, os.O_WRONLY | os.O_CREAT | (os.O_TRUNC if fresh else 0), 0o644)
+        if fresh:
+            os.ftruncate(self.fd, file_size)
+        self.ranges = missing_ranges(self.bitmap, self.chunks)
+        self.packets = PacketMap(self.ranges)
+        self.next_seq_num = 1  # Wire sequence number of the next packet written
+        self.written = 0  # Bytes written in this transfer
+        self.save()
+
+    # Write the next packet in wire order at its place in the file
+    def write(self, data):
+        if not data or self.next_seq_num > self.packets.count:
+            return 0  # The empty FIN packet
+        seq_num = self.packets.packet(self.next_seq_num)
+        os.pwrite(self.fd, data, (seq_num - 1) * PACKET_DATA_SIZE)
+        self.bitmap[(seq_num - 1) // 8] |= 1 << ((seq_num - 1) % 8)
+        self.next_seq_num += 1
+        self.written += len(data)
+        if time.monotonic() - self.saved >= RESUME_SAVE_INTERVAL:
+            self.save()
+        return len(data)
+
+    def tell(self):
+        return self.written
+
+    # Save the bitmap, through a temporary file so a crash never leaves half a state behind
+    def save(self):
+        with open(f'{self.state_name}.tmp', 'wb') as f:
+            f.write(RESUME_HEADER.pack(RESUME_MAGIC, self.file_size, PACKET_DATA_SIZE, self.mtime, len(self.source)))
+            f.write(self.source)
+            f.write(self.bitmap)
+        os.replace(f'{self.state_name}.tmp', self.state_name)
+        self.saved = time.monotonic()
+
+    # Save the state, or remove it once every packet has been received
+    def close(self):
+        os.close(self.fd)
+        if missing_ranges(self.bitmap, self.chunks, 1):
+            self.save()
+        else:
+            os.remove(self.state_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Block stream of a compressed transfer, written to a temporary file before the handshake so the senders map
+# and send it like any other file. name is the path of the stream, with the extension of the original file.
+# The senders need the number of packets up front, so the whole file is compressed before the first packet
+# goes out, and the stream takes up to the size of the file again in the temporary directory while it is sent.
+class CompressedFile:
+    def __init__(self, file_name, method):
+        block_method, compress = COMPRESSORS[method]
+        start_time = time.time()
+        self.file_bytes = 0
+        self.blocks = 0
+        self.compressed_blocks = 0
+        skip = 0  # Blocks still to send raw after a poor one
+        backoff = 1  # Blocks to send raw after the next poor one
+        with open(file_name, 'rb') as f, tempfile.NamedTemporaryFile('wb', suffix='.' + file_name.split('.')[-1], delete=False) as out:
+            self.name = out.name
+            while True:
+                block = f.read(COMPRESS_BLOCK)
+                if not block:
+                    break
+                self.file_bytes += len(block)
+                self.blocks += 1
+                data = None
+                if skip:
+                    skip -= 1
+                else:
+                    data = compress(block)
+                    if len(data) <= COMPRESS_RATIO * len(block):
+                        backoff = 1
+                    else:
+                        data = None  # Not worth it, and probably neither are the next blocks
+                        skip = backoff
+                        backoff = min(backoff * 2, COMPRESS_BACKOFF)
+                if data is None:
+                    out.write(BLOCK_STRUCT.pack(BLOCK_RAW, len(block)))
+                    out.write(block)
+                else:
+                    out.write(BLOCK_STRUCT.pack(block_method, len(data)))
+                    out.write(data)
+                    self.compressed_blocks += 1
+            self.wire_bytes = out.tell()
+        self.duration = time.time() - start_time
+
+    # Largest stream a file of file_size bytes can give: every block raw, after its block header
+    @staticmethod
+    def max_size(file_size):
+        return file_size + (file_size + COMPRESS_BLOCK - 1) // COMPRESS_BLOCK * BLOCK_STRUCT.size
+
+    def summary(self):
+        ratio = self.wire_bytes / self.file_bytes * 100 if self.file_bytes else 100
+        return (f'Compression: {round(self.file_bytes / 1024, 2)} KB file sent as {round(self.wire_bytes / 1024, 2)} KB ({ratio:.1f}%), '
+                f'{self.compressed_blocks} of {self.blocks} blocks compressed in {self.duration:.2f} s')
+
+    def close(self):
+        os.remove(self.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Output file of a compressed transfer, used by the receivers in place of the file object they would open.
+# The data arrives in order, and every piece is parsed as it comes: block headers are collected, and the bytes of
+# a block go through the block's decompressor straight into the file, so no block is ever buffered whole.
+class Decompressor:
+    def __init__(self, f):
+        self.f = f
+        self.header = bytearray()  # Bytes of the next block header received so far
+        self.remaining = 0  # Bytes of the current block still to come
+        self.decoder = None  # Decompressor of the current block, None for a raw block
+        self.wire_bytes = 0
+        self.file_bytes = 0
+
+    def write(self, data):
+        view = memoryview(data)
+        self.wire_bytes += len(view)
+        while view:
+            if not self.remaining:
+                # Collect the block header, it may be split over two packets
+                need = BLOCK_STRUCT.size - len(self.header)
+                self.header += view[:need]
+                view = view[need:]
+                if len(self.header) == BLOCK_STRUCT.size:
+                    method, self.remaining = BLOCK_STRUCT.unpack(self.header)
+                    self.header.clear()
+                    self.decoder = DECOMPRESSORS[method]() if DECOMPRESSORS[method] else None
+                continue
+            chunk = view[:self.remaining]
+            view = view[len(chunk):]
+            self.remaining -= len(chunk)
+            self.file_bytes += self.f.write(self.decoder.decompress(chunk) if self.decoder else chunk)
+        return len(data)
+
+    def tell(self):
+        return self.f.tell()
+
+    def close(self):
+        if self.remaining or self.header:
+            print("The compressed data ended in the middle of a block, the file is incomplete")
+        ratio = self.wire_bytes / self.file_bytes * 100 if self.file_bytes else 100
+        print(f'Decompression: {round(self.wire_bytes / 1024, 2)} KB received as {round(self.file_bytes / 1024, 2)} KB ({ratio:.1f}%)')
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Reusable receive buffer for DRTP packets.
+# recvfrom_into fills the same preallocated bytearray for every datagram and the header is decoded in place
+# with unpack_from, so receiving a packet allocates neither a new bytes object nor sliced copies of it.
+# The payload is returned as a memoryview that is only valid until the next call to receive.
+class ReceiveBuffer:
+    def __init__(self, size=MAX_PACKET_SIZE):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+
+    # Receive one packet, returns (seq, ack, flags, window, payload, address)
+    def receive(self, sock):
+        while True:
+            nbytes, address = sock.recvfrom_into(self.buffer)
+            if nbytes >= HEADER_SIZE:
+                break
+            logging.warning("Received data is less than 12 bytes. Ignoring this packet.")
+        seq, ack, flags, window = unpack_header(self.buffer)
+        return seq, ack, flags, window, self.view[HEADER_SIZE:nbytes], address
+
+# Retransmission timeout estimator for one connection, following RFC 6298.
+# Every transmitted sequence number is timestamped and the matching ACK gives an RTT sample, which updates
+# the smoothed RTT (srtt) and the RTT variance (rttvar). The timeout is srtt + max(G, 4 * rttvar) and doubles on every
+# timeout (exponential backoff). Retransmitted packets are never sampled since their ACK is ambiguous (Karn).
+class RTTEstimator:
+    def __init__(self, initial_rto=INITIAL_RTO):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.sent_times = {}  # Send time of every sequence number in flight that may still be sampled
+
+    # Timestamp a packet sent for the first time
+    def on_send(self, seq):
+        self.sent_times[seq] = time.monotonic()
+
+    # Forget the timestamp of a retransmitted packet (Karn's algorithm)
+    def on_retransmit(self, seq):
+        self.sent_times.pop(seq, None)
+
+    # Take an RTT sample from the ACK of seq. A cumulative ACK also forgets every older sequence number.
+    def on_ack(self, seq, cumulative=False):
+        sent_time = self.sent_times.pop(seq, None)
+        if sent_time is not None:
+            rtt = time.monotonic() - sent_time
+            self.sample(rtt)
+            event(EVENT_RTT, seq, None, int(rtt * 1000000))
+        if cumulative:
+            # Sequence numbers are timestamped in increasing order, so the oldest are first in the dict
+            while self.sent_times:
+                oldest = next(iter(self.sent_times))
+                if oldest > seq:
+                    break
+                del self.sent_times[oldest]
+
+    # Update srtt, rttvar and the timeout with one RTT measurement
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + max(4 * self.rttvar, RTO_GRANULARITY), MIN_RTO), MAX_RTO)
+
+    # Back off after a timeout
+    def on_timeout(self):
+        self.rto = min(self.rto * 2, MAX_RTO)
+
+    # Text for the transfer statistics
+    def summary(self):
+        if self.srtt is None:
+            return f'No RTT samples, current RTO {self.rto * 1000:.1f} ms'
+        return f'Smoothed RTT {self.srtt * 1000:.2f} ms, RTT variance {self.rttvar * 1000:.2f} ms, current RTO {self.rto * 1000:.1f} ms'
+
+# Congestion control for the GBN and SR senders.
+# A sender asks window() how many packets may be in flight and reports every event to its controller:
+# on_ack for newly acknowledged packets, on_dup_ack and on_loss for duplicate ACKs and a loss detected
+# from them, and on_timeout when a retransmission timer expires. The base class keeps a fixed window.
+class FixedWindow:
+    name = 'fixed'
+
+    def __init__(self, window=DEFAULT_WINDOW, max_window=MAX_WINDOW):
+        self.cwnd = float(window)
+        self.max_window = max(max_window, window)
+        self.ssthresh = float(self.max_window)  # Slow start threshold
+
+    # Number of packets that may be in flight
+    def window(self):
+        return max(1, min(int(self.cwnd), self.max_window))
+
+    def on_ack(self, acked):
+        pass
+
+    def on_dup_ack(self):
+        pass
+
+    def on_loss(self):
+        pass
+
+    def on_timeout(self):
+        pass
+
+    # Text for the transfer statistics
+    def summary(self):
+        return f'Congestion control: {self.name}, window {self.window()} packets, ssthresh {self.ssthresh:.1f}'
+
+# Additive increase, multiplicative decrease without slow start: the window grows by one packet
+# per window of ACKs and is halved on every loss
+class AIMD(FixedWindow):
+    name = 'aimd'
+
+    def __init__(self, window=DEFAULT_WINDOW, max_window=MAX_WINDOW):
+        super().__init__(1, max_window)
+
+    def on_ack(self, acked):
+        self.cwnd = min(self.cwnd + acked / self.cwnd, self.max_window)
+
+    def on_loss(self):
+        self.cwnd = max(self.cwnd / 2, 1)
+
+    def on_timeout(self):
+        self.on_loss()
+
+# TCP Reno: slow start up to ssthresh, then congestion avoidance. A loss from duplicate ACKs halves
+# the window and enters fast recovery, a timeout starts over from one packet.
+class Reno(FixedWindow):
+    name = 'reno'
+
+    def __init__(self, window=DEFAULT_WINDOW, max_window=MAX_WINDOW):
+        super().__init__(1, max_window)
+        self.recovery = False  # True during fast recovery
+
+    def on_ack(self, acked):
+        if self.recovery:
+            # New data acknowledged, deflate the window and leave fast recovery
+            self.cwnd = self.ssthresh
+            self.recovery = False
+        elif self.cwnd < self.ssthresh:
+            self.cwnd += acked  # Slow start
+        else:
+            self.cwnd += acked / self.cwnd  # Congestion avoidance
+        self.cwnd = min(self.cwnd, self.max_window)
+
+    def on_dup_ack(self):
+        if self.recovery:
+            self.cwnd = min(self.cwnd + 1, self.max_window)  # Every duplicate ACK means a packet has left the network
+
+    def on_loss(self):
+        if not self.recovery:
+            self.ssthresh = max(self.cwnd / 2, 2)
+            self.cwnd = self.ssthresh + 3
+            self.recovery = True
+
+    def on_timeout(self):
+        self.ssthresh = max(self.cwnd / 2, 2)
+        self.cwnd = 1
+        self.recovery = False
+
+# CUBIC (RFC 8312): after a loss the window follows W(t) = C * (t - K)^3 + w_max, where t is the time since
+# the loss, so it grows quickly back towards the window where the loss happened and probes carefully around it
+class Cubic(Reno):
+    name = 'cubic'
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self, window=DEFAULT_WINDOW, max_window=MAX_WINDOW):
+        super().__init__(window, max_window)
+        self.w_max = 0.0  # Window before the last reduction
+        self.epoch_start = None  # Start of the current congestion avoidance epoch
+        self.k = 0.0  # Time the cubic function needs to reach w_max
+
+    def on_ack(self, acked):
+        if self.recovery:
+            self.cwnd = self.ssthresh
+            self.recovery = False
+            return
+        if self.cwnd < self.ssthresh:
+            self.cwnd = min(self.cwnd + acked, self.max_window)  # Slow start
+            return
+        now = time.monotonic()
+        if self.epoch_start is None:
+            self.epoch_start = now
+            if self.cwnd < self.w_max:
+                self.k = ((self.w_max - self.cwnd) / self.C) ** (1 / 3)
+            else:
+                self.k = 0.0
+                self.w_max = self.cwnd
+        target = self.C * (now - self.epoch_start - self.k) ** 3 + self.w_max
+        if target > self.cwnd:
+            self.cwnd += (target - self.cwnd) / self.cwnd * acked
+        else:
+            self.cwnd += 0.01 * acked / self.cwnd  # Grow very slowly on the plateau around w_max
+        self.cwnd = min(self.cwnd, self.max_window)
+
+    # Remember where the loss happened and reduce the window by BETA
+    def reduce(self):
+        self.w_max = self.cwnd
+        self.ssthresh = max(self.cwnd * self.BETA, 2)
+        self.epoch_start = None
+
+    def on_loss(self):
+        if not self.recovery:
+            self.reduce()
+            self.cwnd = self.ssthresh
+            self.recovery = True
+
+    def on_timeout(self):
+        self.reduce()
+        self.cwnd = 1
+        self.recovery = False
+
+# Available congestion controllers by name
+CONGESTION_CONTROLS = {
+    'fixed': FixedWindow,
+    'aimd': AIMD,
+    'reno': Reno,
+    'cubic': Cubic,
+}
+
+# Function to sleep until a time.monotonic() deadline with microsecond precision
+def sleep_until(deadline):
+    remaining = deadline - time.monotonic()
+    if remaining > SPIN_TIME:
+        time.sleep(remaining - SPIN_TIME)
+    while time.monotonic() < deadline:
+        pass
+
+# Token-bucket pacer for the GBN and SR senders.
+# Tokens are bytes that flow in at rate bytes per second up to a burst of PACING_BURST packets, and a packet is
+# only sent once there are tokens for it, so a window goes out spread over the RTT instead of in one burst that
+# overflows a small router queue. With rate 0 the rate is estimated from the window and the smoothed RTT (the
+# first window, before any RTT sample, is not paced), and with rate None pacing is off.
+# The senders read ACKs during long gaps instead of sleeping through them: an ACK left waiting in the socket
+# would make its RTT sample, and with it the estimated rate, look worse than the path is. Go-Back-N paces the
+# windows it resends like new packets, while the single packets Selective Repeat resends are only charged to
+# the bucket, so they hold back the new packets after them without delaying the other timers.
+class Pacer:
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.estimated = rate == 0
+        self.burst = PACING_BURST * MAX_PACKET_SIZE
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.delayed = 0  # Packets that had to wait for tokens
+        self.waited = 0.0  # Time spent waiting for tokens, in seconds
+        self.held_since = None  # When the sender started reading ACKs while the next packet waits for tokens
+
+    # Follow the congestion window and the RTT of the sender when the rate is estimated
+    def update(self, cc, srtt):
+        if self.estimated and srtt:
+            gain = PACING_SS_GAIN if cc.cwnd < cc.ssthresh else PACING_GAIN
+            self.rate = gain * cc.window() * MAX_PACKET_SIZE / srtt
+
+    # Time until nbytes may be sent, 0 when they may be sent now
+    def delay(self, nbytes):
+        if not self.rate:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        return max(0, (nbytes - self.tokens) / self.rate)
+
+    # The sender reads ACKs instead of sleeping until the next packet may go, the packet counts as delayed
+    # from now until wait lets it go
+    def hold(self):
+        if self.held_since is None:
+            self.held_since = time.monotonic()
+
+    # Wait until nbytes may be sent and take the tokens for them
+    def wait(self, nbytes):
+        if not self.rate:
+            return
+        delay = self.delay(nbytes)
+        if delay:
+            sleep_until(self.last + delay)
+            self.tokens = nbytes  # The tokens that flowed in while waiting
+            self.last += delay
+        if self.held_since is not None:
+            self.delayed += 1
+            self.waited += time.monotonic() - self.held_since
+            self.held_since = None
+        elif delay:
+            self.delayed += 1
+            self.waited += delay
+        self.tokens -= nbytes
+
+    # Take the tokens for nbytes that are sent now anyway
+    def charge(self, nbytes):
+        if self.rate:
+            self.delay(nbytes)  # Add the tokens that flowed in since the last packet
+            self.tokens -= nbytes
+
+    # Text for the transfer statistics
+    def summary(self):
+        if self.rate is None:
+            return 'Pacing: off'
+        mode = 'estimated, last rate' if self.estimated else 'rate'
+        return f'Pacing: {mode} {self.rate * 8 / 1000000:.2f} Mbps, {self.delayed} packets delayed for {self.waited:.3f} s'
+
+# Function to parse the --pace option: a rate in Mbps, or auto to estimate it. Returns bytes per second.
+def pace_rate(value):
+    if value == 'auto':
+        return 0
+    rate = float(value)
+    if rate <= 0:
+        raise argparse.ArgumentTypeError("the pacing rate must be positive")
+    return rate * 1000000 / 8
+
+# Function to read the options from the payload of a SYN or SYN-ACK packet
+def decode_options(data):
+    if len(data) < OPTIONS_STRUCT.size:
+        return 0  # The peer does not know about options
+    return OPTIONS_STRUCT.unpack_from(data)[0]
+
+# Function to build the SACK extension of an ACK packet
+def encode_sack(cumulative, bitmap):
+    return SACK_STRUCT.pack(cumulative, bitmap & ((1 << SACK_BITS) - 1))
+
+# Function to list every sequence number from base onwards that a SACK extension acknowledges
+def decode_sack(data, base):
+    cumulative, bitmap = SACK_STRUCT.unpack_from(data)
+    acked = list(range(base, cumulative + 1))
+    seq = cumulative + 1
+    while bitmap:
+        if bitmap & 1 and seq >= base:
+            acked.append(seq)
+        bitmap >>= 1
+        seq += 1
+    return acked
+
+# Delayed and coalesced ACKs for the GBN and SR receivers.
+# The receiver acknowledges every `every` data packets, or `delay` seconds after the first packet that is not
+# acknowledged yet, whichever comes first. Packets that reveal a gap, duplicates and FIN are acknowledged
+# immediately so the sender learns about a loss without waiting. The counters give the ACK-to-data ratio.
+class AckPolicy:
+    def __init__(self, every=ACK_EVERY, delay=ACK_DELAY):
+        self.every = every
+        self.delay = delay
+        self.pending = 0  # Data packets received since the last ACK
+        self.deadline = None  # Time the held back ACK must be sent
+        self.data_packets = 0
+        self.acks = 0
+
+    # Count a received data packet
+    def on_data(self):
+        self.data_packets += 1
+        self.pending += 1
+        if self.deadline is None:
+            self.deadline = time.monotonic() + self.delay
+
+    # Decide whether to send an ACK now, immediate is set for gaps, duplicates and FIN
+    def should_ack(self, immediate):
+        return immediate or self.pending >= self.every or time.monotonic() >= self.deadline
+
+    # Count a sent ACK
+    def sent(self):
+        self.acks += 1
+        self.pending = 0
+        self.deadline = None
+
+    # Socket timeout to use while waiting for the next packet: the idle timeout, or less while an ACK is held back
+    def timeout(self, idle_timeout):
+        if not self.pending:
+            return idle_timeout
+        remaining = max(self.deadline - time.monotonic(), 0.0001)
+        return remaining if idle_timeout is None else min(remaining, idle_timeout)
+
+    # Text for the transfer statistics
+    def summary(self):
+        ratio = self.acks / self.data_packets if self.data_packets else 0
+        return f'ACKs sent: {self.acks} for {self.data_packets} data packets (ACK-to-data ratio {ratio:.2f})'
+
+# Function to send the metadata packet and wait for its ACK, returns the bytes sent or None if it was never acknowledged
+def send_metadata(sock, address, metadata, ack, checksum=None):
+    data = metadata.pack()
+    packet = create_packet(checksum.crc(0, 0, data) if checksum else 0, 0, 0, 0, data)
+    rx = ReceiveBuffer()
+    sent_bytes = 0
+    for _ in range(METADATA_RETRIES):
+        sent_bytes += sock.sendto(packet, address)
+        print(f"Sent metadata: {metadata}")
+        deadline = time.monotonic() + INITIAL_RTO
+        try:
+            while time.monotonic() < deadline:
+                _, ack_num, flag, _, _, _ = rx.receive(sock)
+                if flag & ACK and ack_num == ack:
+                    print(f"Received ack for metadata: {ack_num}")
+                    return sent_bytes
+        except socket.timeout:
+            pass  # Send it again
+    print("No ACK for the metadata packet, giving up")
+    return None
+
+# Function to wait for the metadata packet of a transfer and acknowledge it, returns its Metadata
+def receive_metadata(sock, ack, window, checksum=None):
+    rx = ReceiveBuffer()
+    while True:
+        crc, seq, flag, _, data, addr = rx.receive(sock)
+        if seq or flag:
+            continue  # Not a metadata packet, the handshake ACK or a packet from before
+        if checksum and not checksum.valid(crc, seq, flag, data):
+            print("Dropped metadata packet: checksum mismatch")
+            continue
+        metadata = parse_metadata(data)
+        if metadata is None:
+            continue
+        sock.sendto(create_packet(ack, ack, ACK, window, b''), addr)
+        print(f"Received metadata: {metadata}")
+        return metadata
 
 # Function to read a file and divide it into DRTP packets
 def read_file_into_packets(filename):
@@ -146,74 +1177,57 @@ def make_packets(file_name):
     # Return the list of packets
     return packets
 
-# Function to send a FIN (finish) packet
-def send_fin(sock, address):
-    # Create a FIN packet
-    fin_packet = create_packet(0, FIN, WINDOW_SIZE, b'')
-    # Send the FIN packet
-    send_packet(sock, fin_packet, address)
-
-def stop_and_wait_send(sock, file_name, address):
+def stop_and_wait_send(sock, file_name, address, ranges=None, checksum=None):
     # Start time
     start_time = time.time()
 
     # Initialize sent_bytes to zero
     sent_bytes = 0
 
-    # Get the file extension
-    file_extension = file_name.split('.')[-1]
-    # Create a packet with the file extension
-    ext_packet = create_packet(0, 0, 0, 0, file_extension.encode())
-    # Send the packet with the file extension
-    sock.sendto(ext_packet, address)
-    # Log the file extension
-    print(f"Sent file extension: {file_extension}")
+    # Reusable header buffer for the data packets and receive buffer for the ACKs
+    ring = SendRing(1, checksum)
+    rx = ReceiveBuffer()
+    rtt = RTTEstimator()  # Only samples the RTT for the trace, the timeout stays fixed
+    sent_seq = 0  # Last packet sent, sending it again is a retransmission
 
-    # Open the file in read binary mode
-    with open(file_name, 'rb') as f:
-        # Start sequence number from 1 as 0 is used for file extension packet
+    # Map the file, a resumed transfer sends only the packets in ranges
+    with FileSource(file_name, ranges=ranges) as source:
+        # Start sequence number from 1 as 0 is used for the metadata packet
         seq = 1
 
-        ack_loss_simulated = False  
-
-        while True:
-            # Read PACKET_DATA_SIZE bytes from the file
-            data = f.read(PACKET_DATA_SIZE)
-            # If no more data is available, exit the loop
-            if not data:
-                break
-
-            # Create a packet with the read data
-            packet = create_packet(0, seq, 0, 0, data)
-            # Send the packet
-            sock.sendto(packet, address)
-            # Update sent_bytes
-            sent_bytes += len(packet)
-            # Log the sequence number of the sent packet
-            print(f"Sent packet with seq: {seq}")
+        while seq <= source.chunks:
+            # Send the header and the payload as one packet and update sent_bytes
+            sent_bytes += ring.send(sock, seq, source.payload(seq), address)
+            # Log the sequence number of the sent packet, and time only its first transmission (Karn's algorithm)
+            if seq == sent_seq:
+                rtt.on_retransmit(seq)
+                event(EVENT_RESEND, seq, "Sent packet with seq: {}")
+            else:
+                rtt.on_send(seq)
+                sent_seq = seq
+                event(EVENT_SEND, seq, "Sent packet with seq: {}")
 
             try:
-                # Try to receive an ACK packet
-                packet, address = sock.recvfrom(1472)
-                # Parse the header of the received packet
-                _, ack, flag, _ = parse_header(packet[:12])
-
-                # If we have not simulated ack loss yet, and sequence number is 5 (example)
-                if not ack_loss_simulated and seq == 5:
-                    # Skip this ack, do not print it, and do not increment sequence number
-                    ack_loss_simulated = True
-                    continue
+                # Try to receive an ACK packet and parse its header
+                _, ack, flag, _, _, address = rx.receive(sock)
+
                 # Log the received acknowledgment
-                print(f"Received ack: {ack}")
+                event(EVENT_ACK, ack, "Received ack: {}")
+                if ack != seq + 1:
+                    continue  # A late ACK of an earlier packet, resend this one
             except socket.timeout:
                 # If a timeout occurs, resend the packet
+                event(EVENT_TIMEOUT, seq)
                 continue
 
-            # Increment the sequence number
+            # The packet is acknowledged, add it to the digest and increment the sequence number
+            rtt.on_ack(seq)
+            if checksum:
+                checksum.update(source.payload(seq))
             seq += 1
 
         # Create a FIN packet to indicate the end of the transmission
-        fin_packet = create_packet(0, seq, FIN, 0, b'')
+        fin_packet = create_fin(seq, checksum)
         # Send the FIN packet
         sock.sendto(fin_packet, address)
         # Update sent_bytes
@@ -232,62 +1246,56 @@ def stop_and_wait_send(sock, file_name, address):
     print(f'Total throughput: {rate} Mbps and the number of bytes sent {no_of_bytes} KB')
 
 # Function to receive files using Stop-and-Wait protocol
-def stop_and_wait_receive(sock, filename, address):
-    # Initial sequence number and window size
-    seq_num = 0
+def stop_and_wait_receive(sock, filename, address, resume=None, checksum=None, decompress=False, total=None, progress=None):
+    # Next sequence number expected, packet 0 was the metadata packet, and window size
+    seq_num = 1
     window = 0
+    rx = ReceiveBuffer()  # Reusable buffer for every packet of the transfer
 
-    # First packet contains the file extension
-    packet, addr = sock.recvfrom(1472)  # Receive the packet
-    _, seq, flag, _ = parse_header(packet[:12])  # Parse the header
-    file_extension = packet[12:].decode()  # Decode the file extension from the packet data
-    print(f"Received file extension: {file_extension}")  # Print the received file extension
-
-    # Use the received extension to create the file
-    filename = f'received_file.{file_extension}'  # Create filename
-
-    # Send ACK for the file extension packet
-    ack_packet = create_packet(seq_num + 1, seq_num + 1, ACK, window, b'')  # Create ACK packet
-    sock.sendto(ack_packet, addr)  # Send ACK packet
-    print(f"Sent ack for packet: {seq_num}")  # Print ACK message
-    seq_num += 1  # Increment sequence number
-
-    # Open the file in write binary mode
-    with open(filename, 'wb') as f:
-        # Initialize a variable to simulate ack loss
-        ack_loss_simulated = False
-
+    # Open the file in write binary mode, preallocated when the size is known, or the partial file of a resumed transfer
+    output = resume or open_output(filename, 0, total)
+    with Decompressor(output) if decompress else output as f:
         while True:
-            packet, addr = sock.recvfrom(1472)  # Receive the packet
-            _, seq, flag, _ = parse_header(packet[:12])  # Parse the header
-            print(f"Received packet: {seq}")  # Print received packet sequence number
-            data = packet[12:]  # Extract data from the packet
+            crc, seq, flag, _, data, addr = rx.receive(sock)  # Receive the packet, data is a view into the buffer
+            event(EVENT_RECEIVE, seq, "Received packet: {}")  # Print received packet sequence number
+            if checksum and not checksum.valid(crc, seq, flag, data):
+                event(EVENT_DROP, seq, "Dropped packet {}: checksum mismatch")  # No ACK, the sender resends it
+                continue
+
+            # The FIN carries the sender's digest instead of file data
+            _, _, fin_flag = parse_flags(flag)
+            if fin_flag:
+                fin_data, data = bytes(data), data[:0]
 
             # If the sequence number of the received packet matches the expected sequence number
             if seq == seq_num:
                 f.write(data)  # Write the received data into the file
+                if checksum:
+                    checksum.update(data)
+                if progress:
+                    progress.update()
                 seq_num += 1  # Increment sequence number
 
-            # If we have not simulated ack loss yet, and sequence number is 5 (example)
-            if not ack_loss_simulated and seq == 5:
-                # Skip this ack, do not send it
-                ack_loss_simulated = True
-                continue
-
             # Create and send ACK packet for the received packet
             ack_packet = create_packet(seq_num, seq_num, ACK, window, b'')
             sock.sendto(ack_packet, addr)
-            print(f"Sent ack for packet: {seq_num}")  # Print ACK message
+            event(EVENT_SEND_ACK, seq_num, "Sent ack for packet: {}")  # Print ACK message
 
             # Check if this is the last packet
-            _, _, fin_flag = parse_flags(flag)
             if fin_flag:
                 print("File received successfully!")  # Print successful file received message
+                if checksum:
+                    checksum.verify(fin_data)
                 break
+        received_bytes = f.tell()
 
-def SR_send(sock, file_name, address):
-    WINDOW_SIZE = 15
-    sock.settimeout(0.5)  # 500 ms timeout
+    # Return the number of bytes received
+    return received_bytes
+
+def SR_send(sock, file_name, address, cc=None, sack=False, peer_window=0, start=0, length=None, pacer=None, ranges=None, checksum=None):
+    cc = cc or FixedWindow()  # Congestion control decides how many packets may be in flight
+    pacer = pacer or Pacer()  # Pacing decides when they may be sent
+    rtt = RTTEstimator()  # The retransmission timeout follows the measured RTT
 
     # Initialize sent_bytes to zero
     sent_bytes = 0
@@ -295,57 +1303,138 @@ def SR_send(sock, file_name, address):
     # Start time
     start_time = time.time()
 
-    # Get the file extension
-    file_extension = file_name.split('.')[-1]
-    # Create a packet with the file extension
-    ext_packet = create_packet(0, 0, 0, 0, file_extension.encode())
-    # Send the packet with the file extension
-    sock.sendto(ext_packet, address)
-    sent_bytes += len(ext_packet) # Update sent_bytes
-    # Log the file extension
-    print(f"Sent file extension: {file_extension}")
-
     base = 1
     next_seq_num = 1
-    packets = {}
-    acked = {}
-
-    # Open the file in read binary mode
-    with open(file_name, 'rb') as f:
-        while True:
-            while next_seq_num < base + WINDOW_SIZE:
-                data = f.read(PACKET_DATA_SIZE)
-                if not data:
-                    break
-                packet = create_packet(0, next_seq_num, 0, 0, data)
-                sock.sendto(packet, address)
-                sent_bytes += len(packet) # Update sent_bytes
-                packets[next_seq_num] = packet
-                acked[next_seq_num] = False
-                print(f"Sent packet with seq: {next_seq_num}")
+    ring = SendRing(cc.max_window, checksum)  # One reusable header per packet in the largest window
+    # Acknowledged flags of the packets in flight, indexed by seq % cc.max_window like the send ring.
+    # A slot is cleared when the base passes it, so memory stays the same however large the file is.
+    acked = [False] * cc.max_window
+    rx = ReceiveBuffer()  # Reusable buffer for the ACKs
+    peer_window = peer_window or cc.max_window  # Window advertised by the receiver, packets in flight are capped by it
+    window = 0  # Congestion window last traced
+
+    # Every unacknowledged packet has its own retransmission timer. The timers are kept in a heap of
+    # (deadline, seq) and deadlines holds the current deadline of each packet, so heap entries of packets
+    # that were acknowledged or rearmed since are stale and skipped when they come up.
+    timers = []
+    deadlines = {}
+
+    backoff_until = 0.0  # Time before which further expired timers do not back off again
+    retransmissions = 0  # Packets resent because their own timer expired
+    window_retransmissions = 0  # Packets a single timer resending the whole window would have sent
+
+    # Loss detection from the ACKs. A packet that is still unacknowledged when a packet DUP_ACK_THRESHOLD
+    # further on has been acknowledged is taken as lost and resent at once, the way DUP_ACK_THRESHOLD duplicate
+    # ACKs work for GBN. The packets up to lost_scan have been checked already, so each one is checked once.
+    highest_acked = 0  # Highest packet acknowledged so far
+    lost_scan = 1  # Next packet to check for loss
+    recovery_point = 0  # Packets up to here were in flight at the last loss, losses among them are the same event
+    fast_retransmissions = 0  # Packets resent because the ACKs showed they were lost
+
+    # Map the file so every payload is a slice of the mapping, only the range from start when length is given
+    with FileSource(file_name, start, length, ranges) as source:
+        while base <= source.chunks:
+            if cc.window() != window:
+                window = cc.window()
+                event(EVENT_WINDOW, base, None, window)  # Traced once per change, after the ACK or timeout that caused it
+            pacer.update(cc, rtt.srtt)
+            pace_delay = 0  # Time until the pacer lets the next new packet go
+            while next_seq_num < base + min(cc.window(), peer_window) and next_seq_num <= source.chunks:
+                pace_delay = pacer.delay(source.packet_size(next_seq_num))
+                if pace_delay > PACING_SLEEP:
+                    pacer.hold()
+                    break  # Read ACKs until the packet may go
+                pacer.wait(source.packet_size(next_seq_num))
+                pace_delay = 0
+                sent_bytes += ring.send(sock, next_seq_num, source.payload(next_seq_num), address) # Update sent_bytes
+                if checksum:
+                    checksum.update(source.payload(next_seq_num))  # Packets are first sent in sequence order
+                rtt.on_send(next_seq_num)
+                deadlines[next_seq_num] = time.monotonic() + rtt.rto
+                heapq.heappush(timers, (deadlines[next_seq_num], next_seq_num))
+                event(EVENT_SEND, next_seq_num, "Sent packet with seq: {}")
                 next_seq_num += 1
 
-            # Acknowledgement and retransmission
-            while base != next_seq_num:
-                try:
-                    packet, address = sock.recvfrom(1472)
-                    _, ack, _, _ = parse_header(packet[:12])
-                    print(f"Received ack: {ack}")
-                    if ack in acked and not acked[ack]:  # Make sure it's an ACK for a packet we sent
-                        acked[ack] = True
-                        while base in acked and acked[base]:  # Move the base if we can
-                            base += 1
-                except socket.timeout:  # If no ACK was received, resend all unacknowledged packets
-                    for seq_num in range(base, next_seq_num):
-                        if not acked[seq_num]:
-                            print(f"Resending packet with seq: {seq_num}")
-                            sock.sendto(packets[seq_num], address)
+            # Collect the packets whose timer has expired
+            now = time.monotonic()
+            expired = []
+            while timers and timers[0][0] <= now:
+                deadline, seq_num = heapq.heappop(timers)
+                if deadlines.get(seq_num) == deadline:
+                    expired.append(seq_num)
+
+            # Resend only those packets and rearm their timers with the backed off timeout. Timers of one loss
+            # burst expire one after another, paced packets even more so, so back off at most once per RTO.
+            if expired:
+                if now >= backoff_until:
+                    rtt.on_timeout()
+                    cc.on_timeout()
+                    backoff_until = now + rtt.rto
+                window_retransmissions += sum(1 for seq_num in range(base, next_seq_num) if not acked[seq_num % cc.max_window])
+                for seq_num in expired:
+                    event(EVENT_TIMEOUT, seq_num)
+                    event(EVENT_RESEND, seq_num, "Resending packet with seq: {}")
+                    pacer.charge(source.packet_size(seq_num))
+                    ring.resend(sock, seq_num, source.payload(seq_num), address)
+                    rtt.on_retransmit(seq_num)
+                    retransmissions += 1
+                    deadlines[seq_num] = now + rtt.rto
+                    heapq.heappush(timers, (deadlines[seq_num], seq_num))
+                continue
 
-            if not data:  # If we've sent all data
-                break
+            # Wait for an ACK until the earliest timer expires, or until the pacer lets the next packet go
+            # There is no timer when the pacer holds back a packet while nothing is in flight
+            wait = timers[0][0] - now if timers else rtt.rto
+            if pace_delay:
+                wait = min(wait, pace_delay)
+            sock.settimeout(wait)
+            try:
+                _, ack, _, win, data, address = rx.receive(sock)
+                event(EVENT_ACK, ack, "Received ack: {}")
+                if win:  # A zero window comes from peers that do not advertise one
+                    peer_window = win
+                acks = [ack]
+                if sack and len(data) >= SACK_STRUCT.size:
+                    # The SACK extension also covers earlier ACKs that were lost
+                    acks.extend(decode_sack(data, base))
+                for ack in acks:
+                    if base <= ack < next_seq_num and not acked[ack % cc.max_window]:  # Make sure it's an ACK for a packet in flight
+                        acked[ack % cc.max_window] = True
+                        del deadlines[ack]  # Stop the timer of the packet
+                        rtt.on_ack(ack)
+                        highest_acked = max(highest_acked, ack)
+                        if ack == base:
+                            cc.on_ack(1)
+                        else:
+                            cc.on_dup_ack()  # Received above a hole, the base cannot move, like a duplicate ACK
+                        while base < next_seq_num and acked[base % cc.max_window]:  # Move the base if we can
+                            acked[base % cc.max_window] = False  # Free the slot for packet base + cc.max_window
+                            base += 1
+                source.release(base)
+
+                # Resend the holes that DUP_ACK_THRESHOLD later packets have overtaken without waiting for their
+                # timers, and reduce the window once per window of data that saw a loss
+                lost_scan = max(lost_scan, base)
+                while lost_scan <= highest_acked - DUP_ACK_THRESHOLD:
+                    seq_num = lost_scan
+                    lost_scan += 1
+                    if acked[seq_num % cc.max_window]:
+                        continue
+                    if seq_num > recovery_point:
+                        cc.on_loss()
+                        recovery_point = next_seq_num - 1
+                    event(EVENT_FAST_RETRANSMIT, seq_num, "Fast retransmit of packet with seq: {}")
+                    pacer.charge(source.packet_size(seq_num))
+                    ring.resend(sock, seq_num, source.payload(seq_num), address)
+                    rtt.on_retransmit(seq_num)
+                    fast_retransmissions += 1
+                    deadlines[seq_num] = time.monotonic() + rtt.rto
+                    heapq.heappush(timers, (deadlines[seq_num], seq_num))
+            except socket.timeout:
+                pass  # The expired timers and the paced packets are handled at the top of the loop
 
     # now that all packets have been acknowledged, send the FIN packet
-    fin_packet = create_packet(0, next_seq_num, FIN, 0, b'')
+    fin_packet = create_fin(next_seq_num, checksum)
     sock.sendto(fin_packet, address)
     sent_bytes += len(fin_packet) # Update sent_bytes
     print(f"Sent FIN packet with seq: {next_seq_num}")
@@ -359,69 +1448,217 @@ def SR_send(sock, file_name, address):
     rate = round((sent_bytes / duration) * 8 / 1000000, 2)
     no_of_bytes = round(sent_bytes / 1024, 2)
     print(f'Total throughput: {rate} Mbps and the number of bytes sent {no_of_bytes} KB')
-
-def SR_receive(sock, filename, address):
-    # Initial sequence number and window size
-    seq_num = 0
-    window = 15
-
+    print(rtt.summary())
+    print(cc.summary())
+    print(pacer.summary())
+    print(f'Receiver window: {peer_window} packets')
+    print(f'Retransmissions: {retransmissions} with per-packet timers, {window_retransmissions} when resending the whole window on timeout')
+    print(f'Fast retransmissions: {fast_retransmissions} packets resent before their timers expired')
+
+def SR_receive(sock, filename, address, sack=False, acks=None, window=DEFAULT_WINDOW, start=0, total=None, resume=None, checksum=None, decompress=False, progress=None):
+    # The first data packet is 1, packet 0 was the metadata packet.
+    # The window is the number of packets the receiver accepts after the last in-order packet
     expected_seq_num = 1
 
-    buffer = {}  # Buffer to hold out-of-order packets
+    buffer = {}  # Buffer to hold out-of-order packets, the ACKs advertise the window minus the buffered packets
 
-    # First packet contains the file extension
-    packet, addr = sock.recvfrom(1472)  # Receive the packet
-    _, seq, flag, _ = parse_header(packet[:12])  # Parse the header
-    file_extension = packet[12:].decode()  # Decode the file extension from the packet
-    # Send ACK for the file extension packet
-    ack_packet = create_packet(seq_num + 1, seq_num + 1, ACK, window, b'')  # Create ACK packet
-    sock.sendto(ack_packet, addr)  # Send ACK packet
-    print(f"Sent ack for packet: {seq_num}")  # Print ACK message
-    seq_num += 1  # Increment sequence number
+    # ACKs can only be held back when SACK is on, otherwise every packet needs its own ACK
+    acks = acks if acks and sack else AckPolicy()
+    idle_timeout = sock.gettimeout()
 
-    # Use the received extension to create the file
-    filename = f'received_file.{file_extension}'  # Create filename
+    rx = ReceiveBuffer()  # Reusable buffer for every packet of the transfer
 
-    # Open the file in write binary mode
-    with open(filename, 'wb') as f:
+    # Open the file in write binary mode, or the shared file of a parallel transfer at the start of the range.
+    # A resumed transfer writes the missing packets into the partial file instead, a compressed one decompresses first
+    output = resume or open_output(filename, start, total)
+    with Decompressor(output) if decompress else output as f:
         while True:
-            packet, addr = sock.recvfrom(1472)  # Receive the packet
-            _, seq, flag, _ = parse_header(packet[:12])  # Parse the header
-            print(f"Received packet: {seq}")  # Print received packet sequence number
-            data = packet[12:]  # Extract data from the packet
+            try:
+                sock.settimeout(acks.timeout(idle_timeout))
+                crc, seq, flag, _, data, addr = rx.receive(sock)  # Receive the packet, data is a view into the buffer
+            except socket.timeout:
+                if not acks.pending:
+                    raise  # Nothing is waiting to be acknowledged, the sender has gone quiet
+                # The delayed ACK timer expired, acknowledge everything received so far
+                ack_packet = create_packet(last_seq, last_seq, ACK, window - len(buffer), encode_sack(expected_seq_num - 1, sum(1 << (s - expected_seq_num) for s in buffer)))
+                sock.sendto(ack_packet, addr)
+                acks.sent()
+                event(EVENT_SEND_ACK, last_seq, "Sent ack for packet: {}")  # Print ACK message
+                continue
+            event(EVENT_RECEIVE, seq, "Received packet: {}")  # Print received packet sequence number
+            if checksum and not checksum.valid(crc, seq, flag, data):
+                event(EVENT_DROP, seq, "Dropped packet {}: checksum mismatch")  # No ACK, the sender resends it
+                continue
+            last_seq = seq
+
+            # Check if this is the last packet, the FIN carries the sender's digest instead of file data
+            _, _, fin_flag = parse_flags(flag)
+            if fin_flag:
+                fin_data, data = bytes(data), data[:0]
 
             if seq >= expected_seq_num and seq < expected_seq_num + window:  # If packet is within current window
+                gap = seq != expected_seq_num or bool(buffer)  # The packet opens or fills a gap
                 if seq == expected_seq_num:
                     f.write(data)  # Write the received data into the file
+                    if checksum:
+                        checksum.update(data)
+                    if progress:
+                        progress.update()
                     expected_seq_num += 1
 
                     # Write consecutive packets in buffer to file
                     while expected_seq_num in buffer:
                         f.write(buffer[expected_seq_num])  # Write the received data into the file
+                        if checksum:
+                            checksum.update(buffer[expected_seq_num])
+                        if progress:
+                            progress.update()
                         del buffer[expected_seq_num]  # Remove packet from buffer
                         expected_seq_num += 1
                 else:
-                    buffer[seq] = data
-
-                # Send ack for received packet
-                ack_packet = create_packet(seq, seq, ACK, window, b'')
-                sock.sendto(ack_packet, addr)
-                print(f"Sent ack for packet: {seq}")  # Print ACK message
+                    buffer[seq] = bytes(data)  # Copy the data, the receive buffer is reused for the next packet
+
+                # Send ack for received packet, with the packets buffered out of order when SACK is on
+                acks.on_data()
+                if acks.should_ack(gap or fin_flag):
+                    sack_data = encode_sack(expected_seq_num - 1, sum(1 << (s - expected_seq_num) for s in buffer)) if sack else b''
+                    ack_packet = create_packet(seq, seq, ACK, window - len(buffer), sack_data)
+                    sock.sendto(ack_packet, addr)
+                    acks.sent()
+                    event(EVENT_SEND_ACK, seq, "Sent ack for packet: {}")  # Print ACK message
             elif seq < expected_seq_num:  # If packet is out of order
-                ack_packet = create_packet(seq, seq, ACK, window, b'')
+                acks.on_data()
+                sack_data = encode_sack(expected_seq_num - 1, sum(1 << (s - expected_seq_num) for s in buffer)) if sack else b''
+                ack_packet = create_packet(seq, seq, ACK, window - len(buffer), sack_data)
                 sock.sendto(ack_packet, addr)
-                print(f"Sent ack for packet: {seq}")  # Print ACK message
+                acks.sent()
+                event(EVENT_SEND_ACK, seq, "Sent ack for packet: {}")  # Print ACK message
+
+            if fin_flag:
+                print("File received successfully!")  # Print successful file received message
+                print(acks.summary())
+                if checksum:
+                    checksum.verify(fin_data)
+                break
+        received_bytes = f.tell() - start
+    sock.settimeout(idle_timeout)
+
+    # Return the number of bytes received
+    return received_bytes
+
+# Function to open the output file of a receiver. The file gets the size of the whole file (total) from the
+# metadata packet and its blocks are allocated at once. A flow of a parallel transfer shares the file with the
+# other flows, so the file is never truncated and is positioned at the start of the range.
+def open_output(filename, start, total):
+    f = os.fdopen(open_preallocated(filename, total), 'r+b')
+    f.seek(start)
+    return f
+
+# Function to open a file for writing at the given size, with its blocks allocated, returns the file descriptor
+def open_preallocated(filename, total):
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+    if os.fstat(fd).st_size != total:
+        os.ftruncate(fd, total)  # Every flow sets the same size, so the order the flows start in does not matter
+    preallocate(fd, 0, total)
+    return fd
+
+def preallocate(fd, offset, length):
+    if length <= 0:
+        return  # posix_fallocate refuses an empty range
+    if hasattr(os, 'posix_fallocate'):
+        os.posix_fallocate(fd, offset, length)
+    else:
+        os.ftruncate(fd, max(os.fstat(fd).st_size, offset + length))
+
+# Function to receive files using Selective Repeat, writing every segment straight to its final offset.
+# Instead of a reorder buffer the receiver keeps a bitmap of the window: bit i is set when packet
+# expected_seq_num + i has been written. Memory is therefore O(window) however much the packets are reordered.
+def SR_receive_positional(sock, filename, address, sack=False, acks=None, window=DEFAULT_WINDOW, start=0, total=None, progress=None):
+    # The first data packet is 1, packet 0 was the metadata packet.
+    # The window is the number of packets the receiver accepts after the last in-order packet
+    expected_seq_num = 1
+    received = 0  # Bitmap of written packets, relative to expected_seq_num, the ACKs advertise the window minus these
+
+    # ACKs can only be held back when SACK is on, otherwise every packet needs its own ACK
+    acks = acks if acks and sack else AckPolicy()
+    idle_timeout = sock.gettimeout()
+
+    rx = ReceiveBuffer()  # Reusable buffer for every packet of the transfer
+
+    # Open the file for positional writes, allocated at the size from the metadata. A range of a parallel transfer
+    # shares the file with the other flows.
+    fd = open_preallocated(filename, total)
+    try:
+        file_size = 0  # End of the highest byte written
+        while True:
+            try:
+                sock.settimeout(acks.timeout(idle_timeout))
+                _, seq, flag, _, data, addr = rx.receive(sock)  # Receive the packet, data is a view into the buffer
+            except socket.timeout:
+                if not acks.pending:
+                    raise  # Nothing is waiting to be acknowledged, the sender has gone quiet
+                # The delayed ACK timer expired, acknowledge everything received so far
+                ack_packet = create_packet(last_seq, last_seq, ACK, window - bin(received).count('1'), encode_sack(expected_seq_num - 1, received))
+                sock.sendto(ack_packet, addr)
+                acks.sent()
+                event(EVENT_SEND_ACK, last_seq, "Sent ack for packet: {}")  # Print ACK message
+                continue
+            event(EVENT_RECEIVE, seq, "Received packet: {}")  # Print received packet sequence number
+            last_seq = seq
 
             # Check if this is the last packet
             _, _, fin_flag = parse_flags(flag)
             if fin_flag:
+                ack_packet = create_packet(seq, seq, ACK, window - bin(received).count('1'), encode_sack(expected_seq_num - 1, received) if sack else b'')
+                sock.sendto(ack_packet, addr)  # Acknowledge the FIN like the other receivers do
                 print("File received successfully!")  # Print successful file received message
+                print(acks.summary())
                 break
 
+            if seq >= expected_seq_num and seq < expected_seq_num + window:  # If packet is within current window
+                gap = seq != expected_seq_num or bool(received)  # The packet opens or fills a gap
+                bit = 1 << (seq - expected_seq_num)
+                if not received & bit:  # Skip duplicates of packets already written
+                    offset = (seq - 1) * PACKET_DATA_SIZE
+                    os.pwrite(fd, data, start + offset)  # Write the data at its final position in the file
+                    if progress:
+                        progress.update()
+                    file_size = max(file_size, offset + len(data))
+                    received |= bit
+
+                    # Slide the window past every packet that is now written in order
+                    while received & 1:
+                        received >>= 1
+                        expected_seq_num += 1
+                else:
+                    gap = True  # A duplicate means an ACK was lost
+
+                # Send ack for received packet, the window bitmap is the SACK bitmap
+                acks.on_data()
+                if acks.should_ack(gap):
+                    ack_packet = create_packet(seq, seq, ACK, window - bin(received).count('1'), encode_sack(expected_seq_num - 1, received) if sack else b'')
+                    sock.sendto(ack_packet, addr)
+                    acks.sent()
+                    event(EVENT_SEND_ACK, seq, "Sent ack for packet: {}")  # Print ACK message
+            elif seq < expected_seq_num:  # If packet is out of order
+                acks.on_data()
+                ack_packet = create_packet(seq, seq, ACK, window - bin(received).count('1'), encode_sack(expected_seq_num - 1, received) if sack else b'')
+                sock.sendto(ack_packet, addr)
+                acks.sent()
+                event(EVENT_SEND_ACK, seq, "Sent ack for packet: {}")  # Print ACK message
+    finally:
+        os.close(fd)
+        sock.settimeout(idle_timeout)
+
+    # Return the number of bytes received
+    return file_size
+
 # Function to send files using Go-Back-N protocol
-def GBN_send(sock, file_name, address):
-    WINDOW_SIZE = 15
-    sock.settimeout(0.5)  # 500 ms timeout
+def GBN_send(sock, file_name, address, cc=None, sack=False, peer_window=0, start=0, length=None, pacer=None, ranges=None, checksum=None):
+    cc = cc or FixedWindow()  # Congestion control decides how many packets may be in flight
+    pacer = pacer or Pacer()  # Pacing decides when they may be sent
+    rtt = RTTEstimator()  # The retransmission timeout follows the measured RTT
+    deadline = time.monotonic() + rtt.rto  # The retransmission timer, restarted by every new cumulative ACK
 
     # Initialize sent_bytes to zero
     sent_bytes = 0
@@ -429,52 +1666,99 @@ def GBN_send(sock, file_name, address):
     # Start time
     start_time = time.time()
 
-    # Get the file extension
-    file_extension = file_name.split('.')[-1]
-    # Create a packet with the file extension
-    ext_packet = create_packet(0, 0, 0, 0, file_extension.encode())
-    # Send the packet with the file extension
-    sock.sendto(ext_packet, address)
-    sent_bytes += len(ext_packet)  # Update sent_bytes
-    # Log the file extension
-    print(f"Sent file extension: {file_extension}")
-
     base = 1
     next_seq_num = 1
-    packets = {}
-
-    # Open the file in read binary mode
-    with open(file_name, 'rb') as f:
-        while True:
-            while next_seq_num < base + WINDOW_SIZE:
-                data = f.read(PACKET_DATA_SIZE)
-                if not data:
-                    break
-                packet = create_packet(0, next_seq_num, 0, 0, data)
-                sock.sendto(packet, address)
-                sent_bytes += len(packet)  # Update sent_bytes
-                packets[next_seq_num] = packet
-                print(f"Sent packet with seq: {next_seq_num}")
+    ring = SendRing(cc.max_window, checksum)  # One reusable header per packet in the largest window
+    rx = ReceiveBuffer()  # Reusable buffer for the ACKs
+    peer_window = peer_window or cc.max_window  # Window advertised by the receiver, packets in flight are capped by it
+    window = 0  # Congestion window last traced
+    dup_acks = 0  # Duplicates of the last cumulative ACK
+
+    # Retransmissions by reason
+    timeout_events = 0
+    timeout_retransmissions = 0
+    fast_retransmit_events = 0
+    fast_retransmissions = 0
+
+    # Map the file so every payload is a slice of the mapping, only the range from start when length is given
+    with FileSource(file_name, start, length, ranges) as source:
+        while base <= source.chunks:
+            if cc.window() != window:
+                window = cc.window()
+                event(EVENT_WINDOW, base, None, window)  # Traced once per change, after the ACK or timeout that caused it
+            pacer.update(cc, rtt.srtt)
+            pace_delay = 0  # Time until the pacer lets the next new packet go
+            while next_seq_num < base + min(cc.window(), peer_window) and next_seq_num <= source.chunks:
+                pace_delay = pacer.delay(source.packet_size(next_seq_num))
+                if pace_delay > PACING_SLEEP:
+                    pacer.hold()
+                    break  # Read ACKs until the packet may go
+                pacer.wait(source.packet_size(next_seq_num))
+                pace_delay = 0
+                if base == next_seq_num:
+                    deadline = time.monotonic() + rtt.rto  # Nothing was in flight, the timer starts with this packet
+                sent_bytes += ring.send(sock, next_seq_num, source.payload(next_seq_num), address)  # Update sent_bytes
+                if checksum:
+                    checksum.update(source.payload(next_seq_num))  # Packets are first sent in sequence order
+                rtt.on_send(next_seq_num)
+                event(EVENT_SEND, next_seq_num, "Sent packet with seq: {}")
                 next_seq_num += 1
 
-            while True:
-                try:
-                    packet, address = sock.recvfrom(1472)
-                    _, ack, flag, _ = parse_header(packet[:12])
-                    print(f"Received ack: {ack}")
-                    base = ack + 1
-                    if base == next_seq_num:
-                        break
-                except socket.timeout:
-                    for seq_num in range(base, next_seq_num):
-                        print(f"Resending packet with seq: {seq_num}")
-                        sock.sendto(packets[seq_num], address)
+            # Wait for an ACK until the timer expires, or until the pacer lets the next packet go
+            wait = deadline - time.monotonic()
+            if pace_delay:
+                wait = min(wait, pace_delay)
+            sock.settimeout(max(wait, SPIN_TIME))
 
-            if not data:
-                break
+            # Slide the window on every new cumulative ACK, resend the whole window on timeout
+            try:
+                _, ack, flag, win, data, address = rx.receive(sock)
+                event(EVENT_ACK, ack, "Received ack: {}")
+                if win:  # A zero window comes from peers that do not advertise one
+                    peer_window = win
+                if sack and len(data) >= SACK_STRUCT.size:
+                    # The Go-Back-N receiver discards out-of-order packets, so only the cumulative part can add anything
+                    ack = max(ack, SACK_STRUCT.unpack_from(data)[0])
+                if ack >= base:  # Ignore ACKs older than the window
+                    cc.on_ack(ack - base + 1)
+                    base = ack + 1
+                    source.release(base)
+                    dup_acks = 0
+                    rtt.on_ack(ack, cumulative=True)
+                    deadline = time.monotonic() + rtt.rto
+                elif ack == base - 1 and base < next_seq_num:
+                    # The receiver acknowledged the same packet again, so it got a packet after a hole
+                    dup_acks += 1
+                    cc.on_dup_ack()
+                    if dup_acks == DUP_ACK_THRESHOLD:
+                        # Fast retransmit: go back to base at once instead of waiting for the timeout
+                        cc.on_loss()
+                        fast_retransmit_events += 1
+                        for seq_num in range(base, next_seq_num):
+                            event(EVENT_FAST_RETRANSMIT, seq_num, "Fast retransmit of packet with seq: {}")
+                            rtt.on_retransmit(seq_num)
+                            pacer.wait(source.packet_size(seq_num))
+                            ring.resend(sock, seq_num, source.payload(seq_num), address)
+                            fast_retransmissions += 1
+                        deadline = time.monotonic() + rtt.rto
+            except socket.timeout:
+                if time.monotonic() < deadline or base == next_seq_num:
+                    continue  # Woken up by the pacer, the timer has not expired or has nothing to resend
+                rtt.on_timeout()
+                cc.on_timeout()
+                deadline = time.monotonic() + rtt.rto
+                dup_acks = 0
+                timeout_events += 1
+                event(EVENT_TIMEOUT, base)
+                for seq_num in range(base, next_seq_num):
+                    event(EVENT_RESEND, seq_num, "Resending packet with seq: {}")
+                    rtt.on_retransmit(seq_num)
+                    pacer.wait(source.packet_size(seq_num))
+                    ring.resend(sock, seq_num, source.payload(seq_num), address)
+                    timeout_retransmissions += 1
 
         # Create a FIN packet to indicate the end of the transmission
-        fin_packet = create_packet(0, next_seq_num, FIN, 0, b'')
+        fin_packet = create_fin(next_seq_num, checksum)
         # Send the FIN packet
         sock.sendto(fin_packet, address)
         sent_bytes += len(fin_packet)  # Update sent_bytes
@@ -490,127 +1774,597 @@ def GBN_send(sock, file_name, address):
     rate = round((sent_bytes / duration) * 8 / 1000000, 2)
     no_of_bytes = round(sent_bytes / 1024, 2)
     print(f'Total throughput: {rate} Mbps and the number of bytes sent {no_of_bytes} KB')
-
-def GBN_receive(sock, filename, addr):
-    # Initial sequence number and window size
-    seq_num = 0
-    window = 15
-
+    print(rtt.summary())
+    print(cc.summary())
+    print(pacer.summary())
+    print(f'Receiver window: {peer_window} packets')
+    print(f'Retransmissions: {timeout_retransmissions} packets after {timeout_events} timeouts, '
+          f'{fast_retransmissions} packets after {fast_retransmit_events} fast retransmits')
+
+def GBN_receive(sock, filename, addr, sack=False, acks=None, window=DEFAULT_WINDOW, start=0, total=None, resume=None, checksum=None, decompress=False, progress=None):
+    # The first data packet is 1, packet 0 was the metadata packet.
+    # The advertised window is static: every ACK carries the whole -w window. In-order packets are written at once
+    # and out-of-order ones are dropped, so no packets wait here. The window only caps the sender at -w, it does
+    # not slow it down when the disk falls behind, the blocking writes do that by delaying the ACKs.
     expected_seq_num = 1
 
-    # First packet contains the file extension
-    packet, addr = sock.recvfrom(1472)  # Receive the packet
-    _, seq, flag, _ = parse_header(packet[:12])  # Parse the header
-    file_extension = packet[12:].decode()  # Decode the file extension from the packet data
-    print(f"Received file extension: {file_extension}")  # Print the received file extension
-
-    # Use the received extension to create the file
-    filename = f'received_file.{file_extension}'  # Create filename
+    # Cumulative ACKs can always be held back, a later ACK covers the earlier ones
+    acks = acks or AckPolicy()
+    idle_timeout = sock.gettimeout()
 
-    # Send ACK for the file extension packet
-    ack_packet = create_packet(seq_num + 1, seq_num + 1, ACK, window, b'')  # Create ACK packet
-    sock.sendto(ack_packet, addr)  # Send ACK packet
-    print(f"Sent ack for packet: {seq_num}")  # Print ACK message
-    seq_num += 1  # Increment sequence number
+    rx = ReceiveBuffer()  # Reusable buffer for every packet of the transfer
 
-    # Open the file in write binary mode
-    with open(filename, 'wb') as f:
+    # Open the file in write binary mode, or the shared file of a parallel transfer at the start of the range.
+    # A resumed transfer writes the missing packets into the partial file instead, a compressed one decompresses first
+    output = resume or open_output(filename, start, total)
+    with Decompressor(output) if decompress else output as f:
         while True:
-            packet, addr = sock.recvfrom(1472)  # Receive the packet
-            _, seq, flag, _ = parse_header(packet[:12])  # Parse the header
-            print(f"Received packet: {seq}")  # Print received packet sequence number
-            data = packet[12:]  # Extract data from the packet
+            try:
+                sock.settimeout(acks.timeout(idle_timeout))
+                crc, seq, flag, _, data, addr = rx.receive(sock)  # Receive the packet, data is a view into the buffer
+            except socket.timeout:
+                if not acks.pending:
+                    raise  # Nothing is waiting to be acknowledged, the sender has gone quiet
+                # The delayed ACK timer expired, send the cumulative ACK
+                sack_data = encode_sack(expected_seq_num - 1, 0) if sack else b''
+                ack_packet = create_packet(expected_seq_num - 1, expected_seq_num - 1, ACK, window, sack_data)
+                sock.sendto(ack_packet, addr)
+                acks.sent()
+                event(EVENT_SEND_ACK, expected_seq_num - 1, "Sent ack for packet: {}")  # Print ACK message
+                continue
+            event(EVENT_RECEIVE, seq, "Received packet: {}")  # Print received packet sequence number
+            if checksum and not checksum.valid(crc, seq, flag, data):
+                event(EVENT_DROP, seq, "Dropped packet {}: checksum mismatch")  # Handled like a lost packet
+                continue
+
+            # Check if this is the last packet, the FIN carries the sender's digest instead of file data
+            _, _, fin_flag = parse_flags(flag)
+            if fin_flag:
+                fin_data, data = bytes(data), data[:0]
 
             # If the sequence number of the received packet matches the expected sequence number
-            if seq == expected_seq_num:
+            gap = seq != expected_seq_num
+            if not gap:
                 f.write(data)  # Write the received data into the file
+                if checksum:
+                    checksum.update(data)
+                if progress:
+                    progress.update()
                 expected_seq_num += 1
 
-            # Create and send ACK packet for the received packet
-            ack_packet = create_packet(expected_seq_num - 1, expected_seq_num - 1, ACK, window, b'')
-            sock.sendto(ack_packet, addr)
-            print(f"Sent ack for packet: {expected_seq_num - 1}")  # Print ACK message
+            # Create and send ACK packet for the received packet, unless the policy holds it back
+            acks.on_data()
+            if acks.should_ack(gap or fin_flag):
+                # Out-of-order packets are discarded, so a SACK extension never has any bits set
+                sack_data = encode_sack(expected_seq_num - 1, 0) if sack else b''
+                ack_packet = create_packet(expected_seq_num - 1, expected_seq_num - 1, ACK, window, sack_data)
+                sock.sendto(ack_packet, addr)
+                acks.sent()
+                event(EVENT_SEND_ACK, expected_seq_num - 1, "Sent ack for packet: {}")  # Print ACK message
 
-            # Check if this is the last packet
-            _, _, fin_flag = parse_flags(flag)
             if fin_flag and seq == expected_seq_num - 1:
                 print("File received successfully!")  # Print successful file received message
+                print(acks.summary())
+                if checksum:
+                    checksum.verify(fin_data)
                 break
+        received_bytes = f.tell() - start
+    sock.settimeout(idle_timeout)
+
+    # Return the number of bytes received
+    return received_bytes
+
+# Function to run the server side of one connection: three-way handshake, file transfer and teardown.
+# packet and address are the first datagram of the connection. Returns the number of bytes received, the
+# transfer time and False if the file does not match the sender's digest, or None if the datagram was not a SYN.
+def serve_connection(sock, args, packet, address, file_name):
+    try:
+        syn = Packet.decode(packet)  # Parsing the header of the received packet, the options follow it
+    except ValueError:
+        return None  # Shorter than a header, not a SYN
+    syn_flag, _, _ = parse_flags(syn.flags)  # Parsing the flags from the header
+    if syn_flag:
+        print("SYN received from client")  # If SYN flag is set, print that SYN is received
+
+    # If the packet is not a SYN packet, wait for the next packet
+    if syn.flags != SYN:
+        return None
+
+    # Accept the options the client asked for that this server supports, byte ranges only when running with -P
+    # Resumable transfers only when running with --resume
+    requested = decode_options(syn.data)
+    options = requested & (SUPPORTED_OPTIONS | OPTION_CHECKSUM | OPTION_COMPRESS | (OPTION_RANGE if args.P else 0) | (OPTION_RESUME if args.resume else 0))
+    if options & (OPTION_RANGE | OPTION_RESUME):
+        options &= ~OPTION_COMPRESS  # Byte ranges and resumed packets are file offsets, a compressed stream has none
+    sack = bool(options & OPTION_SACK)
+    checksum = Checksum() if options & OPTION_CHECKSUM else None
+    decompress = bool(options & OPTION_COMPRESS)
+    offset = HEADER_SIZE + OPTIONS_STRUCT.size  # Where the data of the next option starts in the SYN
+    prefix = None if args.keep_name else file_name  # Output file name, completed with the name from the client
+
+    # A flow of a parallel transfer writes its byte range into the shared file
+    start, total = 0, None
+    if requested & OPTION_RANGE:
+        if options & OPTION_RANGE and len(packet) >= offset + RANGE_STRUCT.size:
+            start, total = RANGE_STRUCT.unpack_from(packet, offset)
+        else:
+            options &= ~OPTION_RANGE
+        offset += RANGE_STRUCT.size
+
+    # A resumable transfer continues in the partial file left by an earlier one, and tells the client what is missing
+    resume = None
+    resume_data = b''
+    if options & OPTION_RESUME:
+        if len(packet) > offset + RESUME_STRUCT.size:
+            file_size, mtime = RESUME_STRUCT.unpack_from(packet, offset)
+            name = str(packet[offset + RESUME_STRUCT.size:], 'utf-8')
+            resume = ResumeFile(output_name(prefix, name), file_size, name, mtime)
+            resume_data = RESUME_COUNT_STRUCT.pack(len(resume.ranges))
+            resume_data += b''.join(RESUME_RANGE_STRUCT.pack(first, last) for first, last in resume.ranges)
+            print(f"Resuming: {resume.packets.count} of {resume.chunks} packets missing")
+        else:
+            options &= ~OPTION_RESUME
+
+    # Send SYN-ACK back to client
+    # Create a SYN-ACK packet with the accepted options and the receive window
+    syn_ack = create_packet(0,0,12,args.w or DEFAULT_WINDOW,OPTIONS_STRUCT.pack(options) + resume_data)
+    sock.sendto(syn_ack, address)  # Send the SYN-ACK packet to the client
+    print("SYN-ACK sent to client")  # Print that SYN-ACK is sent to the client
+
+    # Wait for each packet at most IDLE_TIMEOUT, from the final ACK of the handshake on, so a client that
+    # disappears after its SYN cannot hold the connection forever
+    sock.settimeout(IDLE_TIMEOUT)
+
+    # Receive final ACK from client
+    packet, address = sock.recvfrom(1472)  # Waiting for the ACK packet from the client
+    _, ack_flag, _, = parse_flags(Packet.decode(packet).flags)  # Parsing the flags from the header
+
+    if ack_flag:
+        print("ACK received from client: Connection established successfully!")  # If ACK flag is set, print that ACK is received
+
+    # The metadata packet names the file and tells how large it is and how many packets follow
+    metadata = receive_metadata(sock, metadata_ack(args.r), args.w or DEFAULT_WINDOW, checksum)
+    if metadata.chunk_size != PACKET_DATA_SIZE:
+        print(f"The client sends packets of {metadata.chunk_size} bytes, this server only receives {PACKET_DATA_SIZE} byte packets")
+        return None
+    filename = output_name(prefix, metadata.name)
+    if total is None:
+        total = metadata.size  # A single flow carries the whole file, preallocated at its size
+    progress = Progress(metadata.chunks)
+
+    # ACK policy of the receiver
+    acks = AckPolicy(args.ack_every, args.ack_delay / 1000)
+
+    # Start time of the transfer
+    start_time = time.time()
+
+    # Receive file based on the selected reliability protocol
+    received_bytes = 0
+    try:
+        if args.r == 'stop_and_wait':
+            received_bytes = stop_and_wait_receive(sock, filename, address, resume, checksum, decompress, total, progress)  # If stop and wait protocol is selected, call the appropriate function
+        elif args.r == 'GBN':
+            received_bytes = GBN_receive(sock, filename, address, sack, acks, args.w or DEFAULT_WINDOW, start, total, resume, checksum, decompress, progress)  # If Go-Back-N protocol is selected, call the appropriate function
+        elif args.r == 'SR':
+            if args.pwrite and resume is None and checksum is None and not decompress:
+                received_bytes = SR_receive_positional(sock, filename, address, sack, acks, args.w or DEFAULT_WINDOW, start, total, progress)  # Write segments to their offsets without a reorder buffer
+            else:
+                # A resumed transfer already writes every packet at its own offset, the digest and the decompression need the packets in order
+                received_bytes = SR_receive(sock, filename, address, sack, acks, args.w or DEFAULT_WINDOW, start, total, resume, checksum, decompress, progress)  # If Selective Repeat protocol is selected, call the appropriate function
+    except socket.timeout:
+        if resume is not None:
+            # The receiver closed the ResumeFile on its way out, which saved the bitmap
+            print(f"Transfer interrupted, the state is saved in {resume.state_name}. Run both sides with --resume again to continue")
+        raise
+    duration = time.time() - start_time
+
+    if args.r == 'SR':
+        sock.settimeout(INITIAL_RTO)  # The client sends its FIN right after the last packet
+        try:
+            packet, address = sock.recvfrom(1472)  # Waiting for a packet from a client
+            _, _, fin_flag = parse_flags(Packet.decode(packet).flags)  # Parsing the flags from the header
+            if fin_flag:
+                print(f"File complete!")  # If FIN flag is set, print that file transmission is complete
+        except socket.timeout:
+            print("No FIN from client, the file is complete anyway")
+
+    return received_bytes, duration, checksum is None or bool(checksum.matched)
+
+# Seeded model of an impaired link, one decision per outgoing datagram. Loss is independent with probability
+# loss, or bursty with the Gilbert-Elliott model when burst = (p, r, h, k) is given: the link moves from the good
+# to the bad state with probability p and back with probability r, and drops with probability k in the good
+# state and h in the bad one. A kept datagram is duplicated with probability duplicate, every copy is delayed by
+# delay plus a uniform jitter of up to jitter either way, and held back hold seconds longer with probability
+# reorder so the datagrams after it overtake it.
+class Impairment:
+    def __init__(self, loss=0.0, burst=None, duplicate=0.0, reorder=0.0, hold=REORDER_HOLD, delay=0.0, jitter=0.0, seed=IMPAIR_SEED):
+        self.loss = loss
+        self.burst = burst
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.hold = hold
+        self.delay = delay
+        self.jitter = jitter
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.bad = False  # Gilbert-Elliott state
+        self.datagrams = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self.reordered = 0
+
+    # Move the Gilbert-Elliott chain one step, or draw an independent loss
+    def lost(self):
+        if self.burst:
+            p, r, h, k = self.burst
+            if self.random.random() < (r if self.bad else p):
+                self.bad = not self.bad
+            return self.random.random() < (h if self.bad else k)
+        return self.random.random() < self.loss
+
+    # Delays in seconds of the copies of the next datagram to send: none when it is dropped, two when it is duplicated
+    def delays(self):
+        self.datagrams += 1
+        if self.lost():
+            self.dropped += 1
+            return []
+        copies = 1
+        if self.duplicate and self.random.random() < self.duplicate:
+            copies = 2
+            self.duplicated += 1
+        delays = []
+        for _ in range(copies):
+            delay = self.delay + (self.random.uniform(-self.jitter, self.jitter) if self.jitter else 0)
+            if self.reorder and self.random.random() < self.reorder:
+                delay += self.hold
+                self.reordered += 1
+            delays.append(max(delay, 0))
+        return delays
+
+    # Text for the transfer statistics
+    def summary(self):
+        dropped = self.dropped / self.datagrams * 100 if self.datagrams else 0
+        return (f'Impairment (seed {self.seed}): {self.datagrams} datagrams, {self.dropped} dropped ({dropped:.1f} %), '
+                f'{self.duplicated} duplicated, {self.reordered} reordered, delay {self.delay * 1000:g} ms +- {self.jitter * 1000:g} ms')
+
+# Function to parse the -t spec, comma-separated key=value pairs: loss=P, ge=P:R[:H[:K]], dup=P, reorder=P[:MS],
+# delay=MS, jitter=MS and seed=N. Probabilities are fractions, times milliseconds.
+def impairment_spec(value):
+    settings = {}
+    try:
+        for item in value.split(','):
+            key, _, number = item.partition('=')
+            key = key.strip()
+            if key == 'ge':
+                numbers = [float(n) for n in number.split(':')]
+                if not 2 <= len(numbers) <= 4:
+                    raise argparse.ArgumentTypeError("ge takes P:R[:H[:K]]")
+                settings['burst'] = tuple(numbers + [1.0, 0.0][len(numbers) - 2:])
+            elif key == 'reorder':
+                probability, _, hold = number.partition(':')
+                settings['reorder'] = float(probability)
+                if hold:
+                    settings['hold'] = float(hold) / 1000
+            elif key in ('loss', 'dup'):
+                settings['loss' if key == 'loss' else 'duplicate'] = float(number)
+            elif key in ('delay', 'jitter'):
+                settings[key] = float(number) / 1000
+            elif key == 'seed':
+                settings['seed'] = int(number)
+            else:
+                raise argparse.ArgumentTypeError(f"unknown impairment '{key}', use loss, ge, dup, reorder, delay, jitter or seed")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid impairment spec '{value}'")
+    probabilities = [settings.get(key, 0) for key in ('loss', 'duplicate', 'reorder')] + list(settings.get('burst', ()))
+    if not all(0 <= probability <= 1 for probability in probabilities):
+        raise argparse.ArgumentTypeError("impairment probabilities must be within [0, 1]")
+    if min(settings.get('delay', 0), settings.get('jitter', 0), settings.get('hold', 0)) < 0:
+        raise argparse.ArgumentTypeError("impairment delays cannot be negative")
+    return Impairment(**settings)
+
+# Function to tell whether a datagram opens or closes a connection. The SYN, the SYN-ACK and the client's ACK of
+# the handshake are sent only once, and so is the FIN, the blocking senders do not wait for its ACK: these always
+# pass the impaired link untouched, so FINs are never impaired. The handshake ACK is told apart by its window of
+# 0, a receiver always advertises at least one free slot. Everything else is resent when lost and is impaired:
+# the metadata packet and its ACK, the data packets and every other ACK, ACK 0 of GBN and the ACKs of FINs too.
+def is_control(data):
+    _, seq, flags, window = unpack_header(data)
+    return flags & (SYN | FIN) or (flags == ACK and seq == 0 and window == 0 and len(data) == HEADER_SIZE)
+
+# UDP socket whose outgoing datagrams go through an Impairment. Datagrams that are delayed wait in a heap of
+# (due time, number, datagram, address) and are sent by a link thread when due. Everything but sending is
+# passed on to the socket, so the senders, receivers and FlowSocket use it like a socket. Datagrams still
+# delayed when the program exits are lost, as on a real link.
+class ImpairedSocket:
+    def __init__(self, sock, impairment):
+        self.sock = sock
+        self.impairment = impairment
+        self.pending = []
+        self.queued = 0  # Datagrams delayed so far, keeps heap entries with the same due time in order
+        self.condition = threading.Condition()  # Guards the heap and the impairment, shared by server threads
+        self.thread = None  # Link thread, started by the first delayed datagram
+        self.closed = False
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def sendto(self, data, address):
+        if is_control(data):
+            return self.sock.sendto(data, address)
+        data = bytes(data)  # The send ring reuses its headers, so a delayed datagram needs its own copy
+        with self.condition:
+            for delay in self.impairment.delays():
+                if delay:
+                    heapq.heappush(self.pending, (time.monotonic() + delay, self.queued, data, address))
+                    self.queued += 1
+                    if self.thread is None:
+                        self.thread = threading.Thread(target=self.deliver, daemon=True)
+                        self.thread.start()
+                    self.condition.notify()
+                else:
+                    self.sock.sendto(data, address)
+        return len(data)
+
+    # The senders hand over the header and the payload separately, the impaired path joins them
+    def sendmsg(self, buffers, ancdata=(), flags=0, address=None):
+        return self.sendto(b''.join(buffers), address)
+
+    # Link thread: send every delayed datagram when it is due, until the socket is closed and nothing waits
+    def deliver(self):
+        with self.condition:
+            while self.pending or not self.closed:
+                if not self.pending:
+                    self.condition.wait()
+                    continue
+                wait = self.pending[0][0] - time.monotonic()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                _, _, data, address = heapq.heappop(self.pending)
+                try:
+                    self.sock.sendto(data, address)
+                except OSError:
+                    pass  # The link loses what cannot be sent
+
+    # Send what is still delayed, then close the socket
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+        self.sock.close()
+
+# Function to put a new socket behind the impairment of -t, or leave it as it is when there is none
+def impair(sock, impairment):
+    return ImpairedSocket(sock, impairment) if impairment else sock
 
 def run_as_server(args):
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:  # Creating a UDP socket
+    # Serve several clients, or the flows of a parallel transfer, at the same time if asked to
+    if args.clients or args.P:
+        run_as_multi_server(args)
+        return
+
+    with impair(socket.socket(socket.AF_INET, socket.SOCK_DGRAM), args.t) as sock:  # Creating a UDP socket, impaired with -t
         sock.bind((args.i, args.p))  # Binding the socket to a specific IP address and port
         print("Waiting for SYN from client...")  # Display message that the server is waiting for a connection
 
-        while True:  # Infinite loop to keep the server running
+        verified = True  # False when the received file does not match the sender's digest
+        while True:  # Keep waiting until a client has connected and sent its file
             # Receive SYN from client
             packet, address = sock.recvfrom(1472)  # Waiting for a packet from a client
-            _,_, flag, _ = parse_header(packet[:12])  # Parsing the header of the received packet
-            syn_flag, _, _ = parse_flags(flag)  # Parsing the flags from the header
-            if syn_flag:
-                print("SYN received from client")  # If SYN flag is set, print that SYN is received
-            
-            # If the packet is not a SYN packet, wait for the next packet
-            if not packet or struct.unpack(HEADER_FORMAT, packet[:12])[2] != SYN:
-                continue
-
-            # Send SYN-ACK back to client
-            syn_ack = create_packet(0,0,12,0,b'')  # Create a SYN-ACK packet
-            sock.sendto(syn_ack, address)  # Send the SYN-ACK packet to the client
-            print("SYN-ACK sent to client")  # Print that SYN-ACK is sent to the client
-
-            # Receive final ACK from client
-            packet, address = sock.recvfrom(1472)  # Waiting for the ACK packet from the client
-            _,_, flag, _ = parse_header(packet[:12])  # Parsing the header of the received packet
-            _, ack_flag, _, = parse_flags(flag)  # Parsing the flags from the header
-            
-            if ack_flag:
-                print("ACK received from client: Connection established successfully!")  # If ACK flag is set, print that ACK is received
-
-             # Set a timeout of 0.5 seconds
-            sock.settimeout(0.5)
-
-            # Define the file name to save received data
-            file_name = 'received_file.txt'
-
-            # Receive file based on the selected reliability protocol
-            if args.r == 'stop_and_wait':
-                stop_and_wait_receive(sock, file_name, address)  # If stop and wait protocol is selected, call the appropriate function
-            elif args.r == 'GBN':
-                GBN_receive(sock, file_name, address)  # If Go-Back-N protocol is selected, call the appropriate function
-            elif args.r == 'SR':
-                SR_receive(sock, file_name, address)  # If Selective Repeat protocol is selected, call the appropriate function
-
-                packet, address = sock.recvfrom(1472)  # Waiting for a packet from a client
-                _,_, flag, _ = parse_header(packet[:12])  # Parsing the header of the received packet
-                _, _, fin_flag = parse_flags(flag)  # Parsing the flags from the header
-                if fin_flag:
-                    print(f"File complete!")  # If FIN flag is set, print that file transmission is complete
+            try:
+                result = serve_connection(sock, args, packet, address, 'received_file')
+                if result is not None:
+                    verified = result[2]
                     break  # Exit the loop after receiving the file
+            except socket.timeout:
+                print("The client went quiet, dropping the connection")
+                break
 
-            if args.r != 'SR':  # For non-SR protocols
-                break  # Exit the loop
-
+        if args.t:
+            print(args.t.summary())
         print("Server is shutting down.")  # Indicate that the server is shutting down after the file is received
+    if not verified:
+        print("Transfer failed: the received file is corrupt")
+        exit(1)
+
+# The part of a shared server socket that belongs to one client.
+# The server reads every datagram from the shared socket and puts it in the queue of the flow of its source
+# address, so a flow only ever sees its own client's packets. A flow has the socket methods the receivers use.
+class FlowSocket:
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.queue = queue.Queue()
+        self.timeout = None
+        self.thread = None  # Thread serving the flow
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    # Wait for the next datagram of this client
+    def next_datagram(self):
+        try:
+            return self.queue.get(timeout=self.timeout)
+        except queue.Empty:
+            raise socket.timeout('timed out')
+
+    def recvfrom(self, bufsize):
+        return self.next_datagram()[:bufsize], self.address
+
+    def recvfrom_into(self, buffer):
+        data = self.next_datagram()
+        nbytes = min(len(data), len(buffer))
+        buffer[:nbytes] = data[:nbytes]
+        return nbytes, self.address
+
+    def sendto(self, data, address):
+        return self.sock.sendto(data, address)
+
+# Function to serve one client of the multi-client server, runs in the thread of its flow
+def serve_flow(flow, args, results, corrupt):
+    host, port = flow.address
+    result = None
+    try:
+        packet, address = flow.recvfrom(1472)  # The SYN that created the flow
+        # The flows of a parallel transfer share one file, other clients each get their own
+        file_name = 'received_file' if args.P else f'received_file_{host}_{port}'
+        result = serve_connection(flow, args, packet, address, file_name)
+    except socket.timeout:
+        print(f"Client {host}:{port} went quiet, dropping the connection")
+    finally:
+        # Every flow adds a result however it ended, the server waits until it has one from each client
+        end_time = time.time()
+        if result is None:
+            results.append((flow.address, 0, end_time, end_time))
+        elif not result[2]:
+            print(f"Client {host}:{port}: the received file is corrupt")
+            corrupt.append(flow.address)
+            results.append((flow.address, 0, end_time, end_time))
+        else:
+            received_bytes, duration, _ = result
+            rate = round((received_bytes / duration) * 8 / 1000000, 2) if duration else 0
+            print(f'Client {host}:{port}: {round(received_bytes / 1024, 2)} KB in {duration:.2f} s, goodput {rate} Mbps')
+            results.append((flow.address, received_bytes, end_time - duration, end_time))
+
+# Function to run a server that receives files from many clients at once.
+# Datagrams are demultiplexed by source address: a SYN from a new address starts a flow with its own
+# handshake, transfer and teardown in a separate thread, and every later datagram from that address goes to it.
+def run_as_multi_server(args):
+    clients = args.clients or args.P  # Every flow of a parallel transfer is a client of its own
+    flows = {}  # Flow of every client address that has connected
+    results = []  # (address, bytes, start, end) of every finished connection
+    corrupt = []  # Addresses of the clients whose file does not match their digest
+
+    with impair(socket.socket(socket.AF_INET, socket.SOCK_DGRAM), args.t) as sock:  # Creating a UDP socket, impaired with -t
+        sock.bind((args.i, args.p))  # Binding the socket to a specific IP address and port
+        sock.settimeout(0.5)  # Wake up regularly to see if all clients are done
+        print(f"Waiting for {clients} clients...")
 
-def run_as_client(args):
+        while len(results) < clients:
+            try:
+                packet, address = sock.recvfrom(MAX_PACKET_SIZE)
+            except socket.timeout:
+                continue
+
+            flow = flows.get(address)
+            if flow is None or not flow.thread.is_alive():
+                if len(packet) < HEADER_SIZE or Packet.decode(packet).flags != SYN:
+                    continue  # Stray packet from a finished or unknown client
+                # A new connection, start its flow
+                flow = FlowSocket(sock, address)
+                flow.thread = threading.Thread(target=serve_flow, args=(flow, args, results, corrupt), daemon=True)
+                flows[address] = flow
+                flow.thread.start()
+            flow.queue.put(packet)
+
+    report_aggregate(results)
+    if args.t:
+        print(args.t.summary())
+    print("Server is shutting down.")
+    if corrupt:
+        print(f"Transfer failed: {len(corrupt)} received files are corrupt")
+        exit(1)
+
+# Function to print the aggregate goodput over the time from the first start to the last end
+def report_aggregate(results):
+    if not results:
+        return
+    total_bytes = sum(received_bytes for _, received_bytes, _, _ in results)
+    # Dropped connections received nothing, their end would only stretch the time of the others
+    spans = [(start, end) for _, received_bytes, start, end in results if received_bytes] or [(0, 0)]
+    duration = max(end for _, end in spans) - min(start for start, _ in spans)
+    rate = round((total_bytes / duration) * 8 / 1000000, 2) if duration else 0
+    print(f'{len(results)} clients: {round(total_bytes / 1024, 2)} KB in {duration:.2f} s, aggregate goodput {rate} Mbps')
+
+# Function to run the client. With start and length it sends only that byte range of the file, as one flow
+# of a parallel transfer. Returns True when the file or the range was sent.
+def run_as_client(args, start=0, length=None):
     if not args.f:  # Check if a file is specified
         print("No file specified. Please specify a file with the -f option.")  # If not, print an error message
         return
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # Create a UDP socket
+    if args.P and length is None:
+        run_parallel_client(args)  # Split the file over several flows
+        return
+    if args.compress:
+        # The stream is written next to the file, send the file as it is if the temporary directory cannot hold it
+        free = shutil.disk_usage(tempfile.gettempdir()).free
+        if CompressedFile.max_size(os.path.getsize(args.f)) > free:
+            print(f"Not enough free space in {tempfile.gettempdir()} to compress {args.f}, sending it uncompressed")
+            return connect_and_send(args, start, length)
+        # Compress before the handshake, the server only waits IDLE_TIMEOUT for the first packet
+        with CompressedFile(args.f, args.compress) as compressed:
+            return connect_and_send(args, start, length, compressed)
+    return connect_and_send(args, start, length)
+
+# Function to run the client side of one connection: three-way handshake, file transfer and teardown.
+# compressed is the block stream of the file when the client was asked to compress it.
+def connect_and_send(args, start=0, length=None, compressed=None):
+    sock = impair(socket.socket(socket.AF_INET, socket.SOCK_DGRAM), args.t)  # Create a UDP socket, impaired with -t
     
     sock.settimeout(0.5)  # Set a timeout of 0.5 seconds
     address = (args.i, args.p)  # Define server address
    
-    syn = create_packet(0,0,8,0,b'')  # Create a SYN packet
+    options = OPTION_SACK if args.sack else 0  # Options to ask the server for
+    if args.checksum:
+        options |= OPTION_CHECKSUM
+    if compressed:
+        options |= OPTION_COMPRESS
+    syn_data = b''
+    if length is not None:
+        # Tell the server where the range goes and how large the whole file is
+        options |= OPTION_RANGE
+        syn_data = RANGE_STRUCT.pack(start, os.path.getsize(args.f))
+    if args.resume:
+        # Tell the server which file this is and which version of it, so it can find what an earlier transfer
+        # of the same file left behind
+        options |= OPTION_RESUME
+        stat = os.stat(args.f)
+        syn_data += RESUME_STRUCT.pack(stat.st_size, stat.st_mtime_ns) + os.path.basename(args.f).encode()
+    syn = create_packet(0,0,8,0,OPTIONS_STRUCT.pack(options) + syn_data if options else b'')  # Create a SYN packet
     sock.sendto(syn, address)  # Send the SYN packet to the server
     print("SYN sent to server")  # Print that SYN is sent to the server
 
     packet, address = sock.recvfrom(1472)  # Wait for a SYN-ACK packet from the server
-    _,_, flag, _ = parse_header(packet[:12])  # Parsing the header of the received packet
-    syn_flag, ack_flag, _, = parse_flags(flag)  # Parsing the flags from the header
+    synack = Packet.decode(packet)  # Parsing the header of the received packet, the server's window and options
+    peer_window = synack.window
+    syn_flag, ack_flag, _, = parse_flags(synack.flags)  # Parsing the flags from the header
     if syn_flag and ack_flag:  # If SYN and ACK flags are set
         print("Received SYN-ACK from server")  # Print that SYN-ACK is received from the server
+    options &= decode_options(synack.data)  # Keep only the options the server accepted
+    sack = bool(options & OPTION_SACK)
+    checksum = Checksum() if options & OPTION_CHECKSUM else None
+    if args.checksum and not checksum:
+        print("The server does not check checksums, sending without them")
+    file_name = args.f  # File the senders map, the block stream when the server decompresses
+    if options & OPTION_COMPRESS:
+        file_name = compressed.name
+    elif compressed:
+        print("The server does not decompress, sending the file as it is")
+    if length is not None and not options & OPTION_RANGE:
+        print("The server does not accept byte ranges, start it with -P")
+        return
+
+    # Send only the ranges the server is missing, or the whole file if it cannot resume
+    ranges = None
+    if options & OPTION_RESUME:
+        offset = HEADER_SIZE + OPTIONS_STRUCT.size
+        count, = RESUME_COUNT_STRUCT.unpack_from(packet, offset)
+        offset += RESUME_COUNT_STRUCT.size
+        ranges = [RESUME_RANGE_STRUCT.unpack_from(packet, offset + i * RESUME_RANGE_STRUCT.size) for i in range(count)]
+        print(f"Resuming: sending {sum(last - first + 1 for first, last in ranges)} missing packets")
+    elif args.resume:
+        print("The server does not resume transfers, start it with --resume. Sending the whole file")
 
    
     ack = create_packet(0,0,4,0,b'')  # Create an ACK packet
@@ -618,18 +2372,557 @@ def run_as_client(args):
     print("ACK sent to client")  # Print that ACK is sent to the server
     #print("ACK sent to server")
 
+    # Congestion control, -w sets the fixed window or the largest window of the adaptive controllers
+    cc = CONGESTION_CONTROLS[args.cc](args.w or DEFAULT_WINDOW, args.w or MAX_WINDOW)
+
+    # Describe the file before sending it: its name and size, and the number of packets this transfer sends
+    if ranges is not None:
+        chunks = PacketMap(ranges).count
+    else:
+        chunks = ((os.path.getsize(file_name) if length is None else length) + PACKET_DATA_SIZE - 1) // PACKET_DATA_SIZE
+    metadata = Metadata(args.f, os.path.getsize(args.f), chunks)
+    if send_metadata(sock, address, metadata, metadata_ack(args.r), checksum) is None:
+        return
+
     # Send file based on the selected reliability protocol
     if args.r == 'stop_and_wait':
-        stop_and_wait_send(sock, args.f, address)  # If stop and wait protocol is selected, call the appropriate function
+        stop_and_wait_send(sock, file_name, address, ranges, checksum)  # If stop and wait protocol is selected, call the appropriate function
     elif args.r == 'GBN':
-        GBN_send(sock, args.f, address)  # If Go-Back-N protocol is selected, call the appropriate function
+        GBN_send(sock, file_name, address, cc, sack, peer_window, start, length, Pacer(args.pace), ranges, checksum)  # If Go-Back-N protocol is selected, call the appropriate function
     elif args.r == 'SR':
-        SR_send(sock, args.f, address)  # If Selective Repeat protocol is selected, call the appropriate function
+        SR_send(sock, file_name, address, cc, sack, peer_window, start, length, Pacer(args.pace), ranges, checksum)  # If Selective Repeat protocol is selected, call the appropriate function
+
+    if checksum:
+        print(f"File digest {checksum.digest.hexdigest()[:16]} sent in the FIN")
+    if options & OPTION_COMPRESS:
+        print(compressed.summary())
 
     # Two-way handshake for connection teardown
     fin = create_packet(0,0,2,0,b'')  # Create a FIN packet
     sock.sendto(fin, address)  # Send the FIN packet to the server
     print("FIN sent to server")  # Print that FIN is sent to the server
+    if args.t:
+        print(args.t.summary())
+    return True
+
+# Function to send one byte range of a parallel transfer, in a worker process.
+# Returns the flow index, the range and when the flow started and ended.
+def run_range_flow(args, index, start, length):
+    setup_events(args, f'{args.trace}.{index}' if args.trace else None)  # Every flow has its own counters, ring and trace
+    if args.t:
+        # Every flow loses other packets, and the same ones on every run
+        args.t.seed += index
+        args.t.random.seed(args.t.seed)
+    start_time = time.time()
+    sent = run_as_client(args, start, length)
+    finish_events(f'{args.events_file}.{index}')
+    return index, start, length if sent else 0, start_time, time.time()
+
+# Function to send a file over args.P flows at once. The file is split into byte ranges on packet boundaries
+# and every range is sent by its own client, with its own socket, in a separate process, so the flows are
+# limited neither by one window nor by one Python thread doing every sendto.
+def run_parallel_client(args):
+    file_size = os.path.getsize(args.f)
+    chunks = (file_size + PACKET_DATA_SIZE - 1) // PACKET_DATA_SIZE
+    per_flow = (chunks + args.P - 1) // args.P * PACKET_DATA_SIZE  # Bytes in every range but the last
+
+    # The server waits for args.P flows, so a file too small to split still gets that many (empty) ranges
+    ranges = []
+    for index in range(args.P):
+        start = min(index * per_flow, file_size)
+        ranges.append((args, index, start, min(per_flow, file_size - start)))
+    with multiprocessing.Pool(args.P) as pool:
+        flows = pool.starmap(run_range_flow, ranges)
+
+    for index, start, length, start_time, end_time in flows:
+        duration = end_time - start_time
+        rate = round((length / duration) * 8 / 1000000, 2) if duration else 0
+        print(f'Flow {index}: bytes {start}-{start + length} ({round(length / 1024, 2)} KB) in {duration:.2f} s, throughput {rate} Mbps')
+
+    # Aggregate throughput over the time from the first start to the last end
+    total_bytes = sum(length for _, _, length, _, _ in flows)
+    duration = max(end for _, _, _, _, end in flows) - min(start for _, _, _, start, _ in flows)
+    rate = round((total_bytes / duration) * 8 / 1000000, 2) if duration else 0
+    print(f'{args.P} flows: {round(total_bytes / 1024, 2)} KB in {duration:.2f} s, aggregate throughput {rate} Mbps')
+
+# The asyncio engine runs the same protocol as the functions above on one event loop: datagrams arrive
+# through a DatagramProtocol and every retransmission timer is a loop.call_later handle, so one thread
+# can serve any number of flows without blocking on a socket.
+
+# Time the asyncio sender waits for the SYN-ACK and for the ACK of its FIN, and how often it asks again
+HANDSHAKE_TIMEOUT = 0.5
+HANDSHAKE_RETRIES = 5
+
+class AsyncSender(asyncio.DatagramProtocol):
+    def __init__(self, args, done):
+        self.args = args
+        self.done = done  # Future resolved when the transfer is over
+        self.loop = asyncio.get_running_loop()
+        self.address = (args.i, args.p)  # Server address, replaced by the source of the SYN-ACK
+        self.transport = None
+        self.state = 'syn'  # syn, meta, data or fin
+        self.timer = None  # Handshake, metadata, FIN and Go-Back-N/stop-and-wait retransmission timer
+        self.timers = {}  # Selective Repeat timer of every packet in flight
+        self.tries = 0  # Number of SYNs, metadata packets or FINs sent without an answer
+
+        # Stop-and-wait is a window of one packet, GBN and SR use the congestion control
+        if args.r == 'stop_and_wait':
+            self.cc = FixedWindow(1, 1)
+        else:
+            self.cc = CONGESTION_CONTROLS[args.cc](args.w or DEFAULT_WINDOW, args.w or MAX_WINDOW)
+        self.rtt = RTTEstimator()
+        self.options = OPTION_SACK if args.sack and args.r != 'stop_and_wait' else 0
+        self.sack = False
+        self.peer_window = self.cc.max_window
+        self.window = 0  # Congestion window last traced
+
+        self.source = FileSource(args.f)
+        self.metadata = Metadata(args.f, self.source.size, self.source.chunks)
+        self.fin_seq = self.source.chunks + 1  # Sequence number of the FIN packet
+        self.base = 1  # Oldest packet not acknowledged
+        self.next_seq_num = 1  # Next packet to send
+        self.acked = set()  # Selective Repeat packets acknowledged above the base
+        self.dup_acks = 0
+        self.retransmissions = 0
+        self.fast_retransmissions = 0
+        self.backoff_until = 0.0  # Time before which further Selective Repeat timeouts do not back off again
+        # Selective Repeat loss detection from the ACKs, like SR_send
+        self.highest_acked = 0  # Highest packet acknowledged so far
+        self.lost_scan = 1  # Next packet to check for loss
+        self.recovery_point = 0  # Packets up to here were in flight at the last loss
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.send_syn()
+
+    def send(self, packet):
+        self.transport.sendto(packet, self.address)
+
+    def send_data(self, seq):
+        self.send(create_packet(0, seq, 0, 0, self.source.payload(seq)))
+
+    # Send the SYN, and again every HANDSHAKE_TIMEOUT until the SYN-ACK arrives
+    def send_syn(self):
+        if self.tries == HANDSHAKE_RETRIES:
+            print("No SYN-ACK from server")
+            self.close()
+            return
+        self.send(create_packet(0, 0, SYN, 0, OPTIONS_STRUCT.pack(self.options) if self.options else b''))
+        print("SYN sent to server")
+        self.tries += 1
+        self.timer = self.loop.call_later(HANDSHAKE_TIMEOUT, self.send_syn)
+
+    def datagram_received(self, data, address):
+        if len(data) < HEADER_SIZE:
+            return
+        _, ack, flag, window = unpack_header(data)
+        payload = memoryview(data)[HEADER_SIZE:]
+
+        if self.state == 'syn':
+            if flag & SYN and flag & ACK:
+                self.established(address, window, payload)
+        elif self.state == 'meta':
+            if flag & ACK and ack == metadata_ack(self.args.r):
+                print(f"Received ack for metadata: {ack}")
+                self.start_data()
+        elif self.state == 'data':
+            if flag & ACK:
+                self.on_ack(ack, window, payload)
+        elif self.state == 'fin':
+            if flag & ACK and ack >= self.fin_seq:
+                print(f"Received ack for FIN: {ack}")
+                self.finish()
+
+    def error_received(self, exc):
+        pass  # ICMP errors, the retransmission timers take care of lost packets
+
+    # SYN-ACK received: finish the handshake and send the metadata packet
+    def established(self, address, window, payload):
+        self.timer.cancel()
+        self.timer = None
+        self.tries = 0
+        self.address = address
+        print("Received SYN-ACK from server")
+        self.options &= decode_options(payload)  # Keep only the options the server accepted
+        self.sack = bool(self.options & OPTION_SACK)
+        if window:
+            self.peer_window = window
+
+        self.send(create_packet(0, 0, ACK, 0, b''))
+        print("ACK sent to server")
+        self.state = 'meta'
+        self.send_metadata()
+
+    # Send the metadata packet, and again every INITIAL_RTO until it is acknowledged
+    def send_metadata(self):
+        if self.tries == METADATA_RETRIES:
+            print("No ACK for the metadata packet, giving up")
+            self.close()
+            return
+        self.send(create_packet(0, 0, 0, 0, self.metadata.pack()))
+        print(f"Sent metadata: {self.metadata}")
+        self.tries += 1
+        self.timer = self.loop.call_later(INITIAL_RTO, self.send_metadata)
+
+    # Metadata acknowledged: send the first window
+    def start_data(self):
+        self.timer.cancel()
+        self.timer = None
+        self.state = 'data'
+        self.start_time = time.time()
+        if self.source.chunks == 0:
+            self.send_fin()
+        else:
+            self.fill_window()
+
+    # Send new packets while the congestion window and the receiver window allow it
+    def fill_window(self):
+        if self.cc.window() != self.window:
+            self.window = self.cc.window()
+            event(EVENT_WINDOW, self.base, None, self.window)
+        limit = min(self.cc.window(), self.peer_window)
+        while self.next_seq_num < self.base + limit and self.next_seq_num <= self.source.chunks:
+            seq = self.next_seq_num
+            self.send_data(seq)
+            self.rtt.on_send(seq)
+            event(EVENT_SEND, seq, "Sent packet: {}")
+            if self.args.r == 'SR':
+                self.timers[seq] = self.loop.call_later(self.rtt.rto, self.on_packet_timeout, seq)
+            self.next_seq_num += 1
+        if self.args.r != 'SR' and self.timer is None and self.base < self.next_seq_num:
+            self.timer = self.loop.call_later(self.rtt.rto, self.on_timeout)
+
+    def on_ack(self, ack, window, payload):
+        event(EVENT_ACK, ack, "Received ack: {}")
+        if window:
+            self.peer_window = window
+
+        if self.args.r == 'SR':
+            # Every ACK names one packet, the SACK bitmap names the packets buffered above the base
+            acks = [ack]
+            if self.sack and len(payload) >= SACK_STRUCT.size:
+                acks.extend(decode_sack(payload, self.base))
+            for seq in acks:
+                timer = self.timers.pop(seq, None)
+                if timer is not None:  # First ACK of a packet still in flight
+                    timer.cancel()
+                    self.acked.add(seq)
+                    self.rtt.on_ack(seq)
+                    self.highest_acked = max(self.highest_acked, seq)
+                    if seq == self.base:
+                        self.cc.on_ack(1)
+                    else:
+                        self.cc.on_dup_ack()  # Received above a hole, the base cannot move, like a duplicate ACK
+                    while self.base in self.acked:
+                        self.acked.remove(self.base)
+                        self.base += 1
+            self.resend_lost()
+        else:
+            # GBN ACKs carry the last packet received in order, stop-and-wait ACKs the next packet expected
+            cumulative = ack - 1 if self.args.r == 'stop_and_wait' else ack
+            if self.sack and len(payload) >= SACK_STRUCT.size:
+                cumulative = max(cumulative, SACK_STRUCT.unpack_from(payload)[0])
+            if self.base <= cumulative < self.next_seq_num:
+                self.cc.on_ack(cumulative - self.base + 1)
+                self.rtt.on_ack(cumulative, cumulative=True)
+                self.base = cumulative + 1
+                self.dup_acks = 0
+                self.restart_timer()
+            elif self.args.r == 'GBN' and cumulative == self.base - 1 and self.base < self.next_seq_num:
+                self.dup_acks += 1
+                self.cc.on_dup_ack()
+                if self.dup_acks == DUP_ACK_THRESHOLD:
+                    # Fast retransmit: resend the window without waiting for the timer
+                    event(EVENT_FAST_RETRANSMIT, self.base, f"{DUP_ACK_THRESHOLD} duplicate ACKs, fast retransmit from packet {{}}")
+                    self.cc.on_loss()
+                    self.resend_window()
+                    self.fast_retransmissions += self.next_seq_num - self.base
+                    self.restart_timer()
+
+        self.source.release(self.base)
+        if self.base > self.source.chunks:
+            self.send_fin()
+        else:
+            self.fill_window()
+
+    # Selective Repeat: resend the holes that DUP_ACK_THRESHOLD later packets have overtaken without waiting for
+    # their timers, and reduce the window once per window of data that saw a loss
+    def resend_lost(self):
+        self.lost_scan = max(self.lost_scan, self.base)
+        while self.lost_scan <= self.highest_acked - DUP_ACK_THRESHOLD:
+            seq = self.lost_scan
+            self.lost_scan += 1
+            timer = self.timers.get(seq)
+            if timer is None:
+                continue  # Already acknowledged
+            if seq > self.recovery_point:
+                self.cc.on_loss()
+                self.recovery_point = self.next_seq_num - 1
+            event(EVENT_FAST_RETRANSMIT, seq, "Fast retransmit of packet {}")
+            timer.cancel()
+            self.rtt.on_retransmit(seq)
+            self.send_data(seq)
+            self.fast_retransmissions += 1
+            self.timers[seq] = self.loop.call_later(self.rtt.rto, self.on_packet_timeout, seq)
+
+    def restart_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.base < self.next_seq_num:
+            self.timer = self.loop.call_later(self.rtt.rto, self.on_timeout)
+
+    def resend_window(self):
+        for seq in range(self.base, self.next_seq_num):
+            self.rtt.on_retransmit(seq)
+            self.send_data(seq)
+            event(EVENT_RESEND, seq, "Resent packet: {}")
+
+    # Go-Back-N and stop-and-wait timeout: resend every packet in flight
+    def on_timeout(self):
+        self.timer = None
+        event(EVENT_TIMEOUT, self.base, "Timeout, resending from packet {}")
+        self.rtt.on_timeout()
+        self.cc.on_timeout()
+        self.dup_acks = 0
+        self.resend_window()
+        self.retransmissions += self.next_seq_num - self.base
+        self.timer = self.loop.call_later(self.rtt.rto, self.on_timeout)
+
+    # Selective Repeat timeout: resend only the packet whose timer expired
+    def on_packet_timeout(self, seq):
+        event(EVENT_TIMEOUT, seq, "Timeout, resending packet {}")
+        now = time.monotonic()
+        if now >= self.backoff_until:  # Back off at most once per RTO, like SR_send
+            self.rtt.on_timeout()
+            self.cc.on_timeout()
+            self.backoff_until = now + self.rtt.rto
+        self.rtt.on_retransmit(seq)
+        self.send_data(seq)
+        self.retransmissions += 1
+        self.timers[seq] = self.loop.call_later(self.rtt.rto, self.on_packet_timeout, seq)
+
+    # Send the FIN packet, and again every RTO until it is acknowledged or the retries run out
+    def send_fin(self):
+        if self.state != 'fin':
+            self.state = 'fin'
+            self.tries = 0
+            self.end_time = time.time()
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.tries == HANDSHAKE_RETRIES:
+            print("No ACK for FIN, closing the connection")
+            self.finish()
+            return
+        self.send(create_packet(0, self.fin_seq, FIN, 0, b''))
+        print(f"Sent FIN packet: {self.fin_seq}")
+        self.tries += 1
+        self.timer = self.loop.call_later(max(self.rtt.rto, HANDSHAKE_TIMEOUT), self.send_fin)
+
+    # FIN acknowledged: tear the connection down and print the transfer statistics
+    def finish(self):
+        self.send(create_packet(0, 0, FIN, 0, b''))
+        print("FIN sent to server")
+
+        duration = self.end_time - self.start_time
+        throughput = round((self.source.size / duration) * 8 / 1000000, 2) if duration else 0
+        print(f'Sent {round(self.source.size / 1024, 2)} KB in {duration:.2f} s, throughput {throughput} Mbps')
+        print(self.rtt.summary())
+        print(self.cc.summary())
+        print(f'Retransmissions: {self.retransmissions} on timeout, {self.fast_retransmissions} fast')
+        self.close()
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        for timer in self.timers.values():
+            timer.cancel()
+        self.source.close()
+        self.transport.close()
+
+    def connection_lost(self, exc):
+        if not self.done.done():
+            self.done.set_result(None)
+
+# Receiving side of one client connection of the asyncio server
+class AsyncReceiverFlow:
+    def __init__(self, server, address, file_name):
+        self.server = server
+        self.address = address
+        self.file_name = file_name
+        self.protocol = server.args.r
+        self.window = server.args.w or DEFAULT_WINDOW
+        self.state = 'syn'  # syn, established, meta, data or done
+        self.sack = False
+        self.file = None
+        self.progress = None
+        self.expected_seq_num = 1
+        self.buffer = {}  # Selective Repeat packets received out of order
+        self.fin_seq = None
+        self.idle = server.loop.call_later(IDLE_TIMEOUT, self.expire)
+
+    def send(self, packet):
+        self.server.transport.sendto(packet, self.address)
+
+    # SACK extension of an ACK, the buffered packets as a bitmap above the last in-order packet
+    def sack_data(self):
+        if not self.sack:
+            return b''
+        return encode_sack(self.expected_seq_num - 1, sum(1 << (s - self.expected_seq_num) for s in self.buffer))
+
+    def on_packet(self, seq, flag, payload):
+        self.idle.cancel()
+        self.idle = self.server.loop.call_later(IDLE_TIMEOUT, self.expire)
+
+        if flag & SYN:
+            if self.state in ('syn', 'established'):  # First SYN or a retransmission after a lost SYN-ACK
+                print(f"SYN received from client {self.address}")
+                options = decode_options(payload) & SUPPORTED_OPTIONS  # Accept the options this server supports
+                self.sack = bool(options & OPTION_SACK) and self.protocol != 'stop_and_wait'
+                self.send(create_packet(0, 0, SYN | ACK, self.window, OPTIONS_STRUCT.pack(options)))
+                print("SYN-ACK sent to client")
+                self.state = 'established'
+            return
+
+        if self.state == 'established':
+            if flag & ACK:
+                print("ACK received from client: Connection established successfully!")
+                self.state = 'meta'
+                return
+            self.state = 'meta'  # The ACK was lost, this is already the metadata packet
+
+        if self.state == 'meta':
+            metadata = parse_metadata(payload) if not flag and not seq else None
+            if metadata is None or metadata.chunk_size != PACKET_DATA_SIZE:
+                return  # Only the metadata packet can open the file
+            print(f"Received metadata: {metadata}")
+            self.file_name = output_name(None if self.server.args.keep_name else self.file_name, metadata.name)
+            self.file = open_output(self.file_name, 0, metadata.size)  # Preallocated at its final size
+            self.progress = Progress(metadata.chunks)
+            ack = metadata_ack(self.protocol)
+            self.send(create_packet(ack, ack, ACK, self.window, b''))  # Send ACK for the metadata packet
+            self.start_time = time.time()
+            self.state = 'data'
+        elif self.state == 'data':
+            event(EVENT_RECEIVE, seq, "Received packet: {}")
+            if self.protocol == 'SR':
+                self.receive_selective(seq, payload)
+            else:
+                self.receive_in_order(seq, payload)
+            if flag & FIN and seq == self.expected_seq_num - 1:
+                self.finish(seq)
+        elif self.state == 'done' and flag & FIN and seq == self.fin_seq:
+            # The ACK of the FIN was lost, acknowledge it again
+            self.send(create_packet(seq, seq, ACK, self.window, self.sack_data()))
+
+    # Stop-and-wait and Go-Back-N: keep only the next packet in order and acknowledge cumulatively
+    def receive_in_order(self, seq, payload):
+        if seq == self.expected_seq_num:
+            self.file.write(payload)
+            self.progress.update()
+            self.expected_seq_num += 1
+        if self.protocol == 'stop_and_wait':
+            ack = self.expected_seq_num  # Stop-and-wait ACKs name the next packet expected
+        else:
+            ack = self.expected_seq_num - 1
+        self.send(create_packet(ack, ack, ACK, self.window, self.sack_data()))
+        event(EVENT_SEND_ACK, ack, "Sent ack for packet: {}")
+
+    # Selective Repeat: buffer packets inside the window and acknowledge each one
+    def receive_selective(self, seq, payload):
+        if self.expected_seq_num <= seq < self.expected_seq_num + self.window:
+            if seq == self.expected_seq_num:
+                self.file.write(payload)
+                self.progress.update()
+                self.expected_seq_num += 1
+                # Write consecutive packets in buffer to file
+                while self.expected_seq_num in self.buffer:
+                    self.file.write(self.buffer.pop(self.expected_seq_num))
+                    self.progress.update()
+                    self.expected_seq_num += 1
+            else:
+                self.buffer[seq] = payload  # The datagram is not reused, keeping the view is enough
+        elif seq >= self.expected_seq_num:
+            return  # Beyond the window, the sender will resend it
+        self.send(create_packet(seq, seq, ACK, self.window - len(self.buffer), self.sack_data()))
+        event(EVENT_SEND_ACK, seq, "Sent ack for packet: {}")
+
+    def finish(self, seq):
+        self.fin_seq = seq
+        self.state = 'done'
+        self.file.close()
+        duration = time.time() - self.start_time
+        received_bytes = os.path.getsize(self.file_name)
+        rate = round((received_bytes / duration) * 8 / 1000000, 2) if duration else 0
+        print("File received successfully!")
+        print(f'Client {self.address}: {round(received_bytes / 1024, 2)} KB in {duration:.2f} s, goodput {rate} Mbps')
+        self.server.flow_finished(self.address, received_bytes, self.start_time, time.time())
+
+    # No packet for IDLE_TIMEOUT: give the flow up, or forget it if it was finished. An aborted flow counts as a
+    # client that received nothing, so the server does not wait for it forever.
+    def expire(self):
+        self.server.flows.pop(self.address, None)
+        if self.state != 'done':
+            print(f"Client {self.address} went quiet, transfer aborted")
+            if self.file is not None:
+                self.file.close()
+            self.state = 'done'
+            now = time.time()
+            self.server.flow_finished(self.address, 0, now, now)
+
+class AsyncServer(asyncio.DatagramProtocol):
+    def __init__(self, args, done):
+        self.args = args
+        self.done = done  # Future resolved when every expected client has finished
+        self.loop = asyncio.get_running_loop()
+        self.transport = None
+        self.flows = {}  # Flow of every client address that has connected
+        self.results = []  # (address, bytes, start, end) of every finished connection
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    # Demultiplex by source address, a SYN from an unknown address opens a new flow
+    def datagram_received(self, data, address):
+        if len(data) < HEADER_SIZE:
+            return
+        _, seq, flag, _ = unpack_header(data)
+        flow = self.flows.get(address)
+        if flow is None or (flow.state == 'done' and flag & SYN):
+            if not flag & SYN:
+                return  # Stray packet from a finished or unknown client
+            if flow is not None:
+                flow.idle.cancel()
+            file_name = f'received_file_{address[0]}_{address[1]}' if self.args.clients else 'received_file'
+            flow = AsyncReceiverFlow(self, address, file_name)
+            self.flows[address] = flow
+        flow.on_packet(seq, flag, memoryview(data)[HEADER_SIZE:])
+
+    def flow_finished(self, address, received_bytes, start, end):
+        self.results.append((address, received_bytes, start, end))
+        if len(self.results) >= (self.args.clients or 1) and not self.done.done():
+            self.done.set_result(None)
+
+async def run_async_server(args):
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+    transport, server = await loop.create_datagram_endpoint(lambda: AsyncServer(args, done), local_addr=(args.i, args.p))
+    print(f"Waiting for {args.clients or 1} clients...")
+    try:
+        await done
+    finally:
+        for flow in server.flows.values():
+            flow.idle.cancel()
+        transport.close()
+    if args.clients:
+        report_aggregate(server.results)
+    print("Server is shutting down.")
+
+async def run_async_client(args):
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+    await loop.create_datagram_endpoint(lambda: AsyncSender(args, done), local_addr=('0.0.0.0', 0))
+    await done
 
 def main():
     # Create a command-line argument parser
@@ -642,7 +2935,26 @@ def main():
     parser.add_argument('-p', type=int, help='Port number')
     parser.add_argument('-r', type=str, choices=['stop_and_wait', 'GBN', 'SR'], help='Reliability method')
     parser.add_argument('-f', type=str, help='File to transfer')
-    parser.add_argument('-t', type=str, help='Test case')
+    parser.add_argument('-t', type=impairment_spec, help='Impair outgoing data packets and ACKs, comma-separated: loss=P, ge=P:R[:H[:K]] '
+                        '(Gilbert-Elliott burst loss), dup=P, reorder=P[:MS], delay=MS, jitter=MS, seed=N')
+    parser.add_argument('-w', type=int, help='GBN/SR window in packets: receive window on the server, sending window on the client')
+    parser.add_argument('--cc', type=str, choices=list(CONGESTION_CONTROLS), default='fixed', help='GBN/SR client: congestion control')
+    parser.add_argument('--sack', action='store_true', help='GBN/SR client: ask for selective-ACK bitmaps in the ACKs')
+    parser.add_argument('--ack-every', type=int, default=ACK_EVERY, help='GBN/SR server: acknowledge every N data packets (SR needs SACK)')
+    parser.add_argument('--ack-delay', type=float, default=ACK_DELAY * 1000, help='GBN/SR server: longest time an ACK is held back, in ms')
+    parser.add_argument('--pace', type=pace_rate, help='GBN/SR client: pace packets at this rate in Mbps, or auto to follow the window and the RTT')
+    parser.add_argument('--clients', type=int, default=0, help='Server: receive from this many clients at the same time, then shut down')
+    parser.add_argument('--pwrite', action='store_true', help='SR server: write segments to their file offsets instead of buffering them')
+    parser.add_argument('-P', type=int, default=0, help='GBN/SR: send the file as this many byte ranges over parallel flows (server and client)')
+    parser.add_argument('--checksum', action='store_true', help='Client: protect every packet with a CRC32 and compare a digest of the file at the end')
+    parser.add_argument('--compress', type=str, choices=list(COMPRESSORS), help='Client: send the file as blocks compressed with zlib or lzma, blocks that do not shrink are sent raw')
+    parser.add_argument('--keep-name', action='store_true', help='Server: save the file under the name the client sent instead of received_file')
+    parser.add_argument('--resume', action='store_true', help='Keep the state of an interrupted transfer (server) and send only what is missing (client)')
+    parser.add_argument('-q', action='store_true', help='Quiet: count per-packet events instead of printing them, print only summaries')
+    parser.add_argument('--events', type=int, default=0, help='Keep the last N per-packet events in memory, dumped at the end and on SIGUSR1')
+    parser.add_argument('--events-file', type=str, default='drtp_events.bin', help='File the kept events are dumped to')
+    parser.add_argument('--trace', type=str, help='Write every per-packet event to this binary trace file, read it with analyze_trace.py')
+    parser.add_argument('--engine', type=str, choices=['blocking', 'asyncio'], default='blocking', help='Run on blocking sockets or on an asyncio event loop')
     
     # Parse the command-line arguments
     args = parser.parse_args()
@@ -651,14 +2963,80 @@ def main():
     if args.p < 1024 or args.p > 65535:
         parser.error("The port number must be within the range [1024, 65535]")
 
+    # The window must fit in the send ring and in the SACK bitmap
+    if args.w is not None and not 1 <= args.w <= MAX_WINDOW:
+        parser.error(f"The window must be within the range [1, {MAX_WINDOW}]")
+
+    # Parallel flows need a sliding window protocol, one flow per process, and cannot be mixed with other clients
+    if args.P:
+        if args.P < 1:
+            parser.error("The number of parallel flows must be at least 1")
+        if args.r not in ('GBN', 'SR'):
+            parser.error("Parallel flows (-P) need -r GBN or -r SR")
+        if args.engine == 'asyncio':
+            parser.error("Parallel flows (-P) run on the blocking engine")
+        if args.clients:
+            parser.error("-P and --clients cannot be combined")
+
+    # The pacer sleeps in the blocking send loops
+    if args.pace is not None and args.engine == 'asyncio':
+        parser.error("--pace runs on the blocking engine")
+
+    # The asyncio receiver acknowledges every packet at once and writes through its reorder buffer
+    if args.engine == 'asyncio':
+        if args.pwrite:
+            parser.error("--pwrite runs on the blocking engine")
+        if args.ack_every != ACK_EVERY:
+            parser.error("--ack-every runs on the blocking engine")
+        if args.ack_delay != ACK_DELAY * 1000:
+            parser.error("--ack-delay runs on the blocking engine")
+
+    # The impaired link wraps the blocking sockets
+    if args.t and args.engine == 'asyncio':
+        parser.error("-t runs on the blocking engine")
+
+    # The asyncio engine does not check checksums
+    if args.checksum and args.engine == 'asyncio':
+        parser.error("--checksum runs on the blocking engine")
+
+    # A compressed file is one stream of blocks, it cannot be split into byte ranges or resumed at a file offset
+    if args.compress and (args.P or args.resume or args.engine == 'asyncio'):
+        parser.error("--compress runs on the blocking engine, without -P or --resume")
+
+    # A resumed transfer needs the same output file name every time, so one client on the blocking engine
+    if args.resume and (args.P or args.clients or args.engine == 'asyncio'):
+        parser.error("--resume works with one client on the blocking engine, without -P or --clients")
+
+    if args.events < 0:
+        parser.error("The number of kept events cannot be negative")
+
+    # Per-packet output, the event ring that can be dumped while the program runs, and the trace. The flows of a
+    # parallel client write their own traces.
+    setup_events(args, None if args.c and args.P else args.trace)
+    if EVENTS.ring is not None and hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: EVENTS.ring.dump(args.events_file))
+
     # Check the specified mode (server or client) and call the appropriate function
-    if args.s:
-        run_as_server(args)  # If -s flag is set, run the program as server
-    elif args.c:
-        run_as_client(args)  # If -c flag is set, run the program as client
-    else:
-        # If neither -s or -c is set, print an error message
-        logging.error("Please specify either -s to run as server or -c to run as client.")
+    try:
+        if args.s and args.engine == 'asyncio':
+            asyncio.run(run_async_server(args))  # Serve on the asyncio event loop
+        elif args.s:
+            run_as_server(args)  # If -s flag is set, run the program as server
+        elif args.c and args.engine == 'asyncio':
+            if not args.f:
+                parser.error("No file specified. Please specify a file with the -f option.")
+            asyncio.run(run_async_client(args))  # Send on the asyncio event loop
+        elif args.c:
+            run_as_client(args)  # If -c flag is set, run the program as client
+        else:
+            # If neither -s or -c is set, print an error message
+            logging.error("Please specify either -s to run as server or -c to run as client.")
+    finally:
+        # The counters replace the per-packet lines in quiet mode, and the ring and the trace are written however
+        # the program ends
+        if args.q or EVENTS.ring is not None:
+            print(EVENTS.summary())
+        finish_events(args.events_file)
 
 # Check if the script is run directly (not imported as a module), and if so, call the main function
 if __name__ == "__main__":
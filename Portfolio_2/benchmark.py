@@ -0,0 +1,432 @@
+import argparse
+import collections
+import contextlib
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import application1 as drtp
+import drtp_codec
+
+# Number of packets sent in each microbenchmark
+PACKET_COUNT = 200000
+
+# Payload used by the microbenchmarks, one full DRTP data packet
+PAYLOAD = bytes(drtp.PACKET_DATA_SIZE)
+
+# Rate-limited path of the pacing benchmark: link rate in bits per second and a drop-tail queue of as many
+# packets as the r3-r4 link of the portfolio topology (max_queue_size=33)
+BOTTLENECK_RATE = 20000000
+BOTTLENECK_QUEUE = 33
+
+# Largest file sent through the bottleneck, in packets
+PACING_PACKETS = 2000
+
+# File size of the memory benchmark in packets, and the peak RSS the sender and receiver must stay below
+MEMORY_PACKETS = 100000
+MEMORY_BOUND = 64 * 1024 * 1024
+
+# Path of the DRTP application, run as server and client by the transfer benchmarks
+APPLICATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'application1.py')
+
+# Function to create a pair of UDP sockets on loopback, returns the sender, the receiver and the receiver address
+def loopback_pair():
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))  # Let the kernel choose a free port
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    return sender, receiver, receiver.getsockname()
+
+# Function to print one benchmark result line
+def report(name, count, duration):
+    print(f"{name:<40} {count / duration:>12.0f} packets/s")
+
+# Send path before the send ring: pack the header, join it with the data and send the copy
+def bench_send_copy(sock, address, count):
+    for seq in range(count):
+        packet = drtp.create_packet(0, seq, 0, 0, PAYLOAD)
+        sock.sendto(packet, address)
+
+# Send path with the send ring: pack the header in place and send header and payload with sendmsg
+def bench_send_ring(sock, address, count):
+    ring = drtp.SendRing(15)
+    payload = memoryview(PAYLOAD)
+    for seq in range(count):
+        ring.send(sock, seq, payload, address)
+
+# Benchmark packets per second of the two send paths on loopback
+def run_send_benchmark(count):
+    print("Send path (loopback)")
+    sender, receiver, address = loopback_pair()
+    with sender, receiver:
+        for name, bench in (('create_packet + sendto', bench_send_copy), ('SendRing + sendmsg', bench_send_ring)):
+            start_time = time.perf_counter()
+            bench(sender, address, count)
+            report(name, count, time.perf_counter() - start_time)
+
+# Receive path before the receive buffer: recvfrom, then slice out the header and the data
+def bench_recv_copy(sender, receiver, address, count, keep):
+    packet_out = drtp.create_packet(0, 1, 0, 0, PAYLOAD)
+    for _ in range(count):
+        sender.sendto(packet_out, address)
+        packet, addr = receiver.recvfrom(1472)
+        header = packet[:12]
+        keep.append((packet, header, drtp.parse_header(header), packet[12:], addr))
+
+# Receive path with the receive buffer: recvfrom_into a reused bytearray and unpack_from in place
+def bench_recv_into(sender, receiver, address, count, keep):
+    packet_out = drtp.create_packet(0, 1, 0, 0, PAYLOAD)
+    rx = drtp.ReceiveBuffer()
+    for _ in range(count):
+        sender.sendto(packet_out, address)
+        keep.append(rx.receive(receiver))
+
+# Benchmark packets per second and allocations per packet of the two receive paths on loopback.
+# Everything a receive produces is kept alive, so the tracemalloc snapshot difference counts every allocation.
+def run_recv_benchmark(count):
+    print("Receive path (loopback)")
+    sender, receiver, address = loopback_pair()
+    with sender, receiver:
+        for name, bench in (('recvfrom + slicing', bench_recv_copy), ('ReceiveBuffer (recvfrom_into)', bench_recv_into)):
+            start_time = time.perf_counter()
+            bench(sender, receiver, address, count, [])
+            report(name, count, time.perf_counter() - start_time)
+
+            # Count the allocations on a shorter run, tracemalloc slows every allocation down
+            samples = min(count, 10000)
+            keep = []
+            tracemalloc.start()
+            before = tracemalloc.take_snapshot()
+            bench(sender, receiver, address, samples, keep)
+            after = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            stats = after.compare_to(before, 'filename')
+            blocks = sum(stat.count_diff for stat in stats) / samples
+            size = sum(stat.size_diff for stat in stats) / samples
+            print(f"{'':<40} {blocks:>12.1f} allocations/packet {size:>8.0f} bytes/packet")
+
+# Per-packet work of the integrity checks on the sender: nothing, the CRC32 in the header, and the digest as well
+def bench_checksum_none(checksum, payloads):
+    for payload in payloads:
+        pass
+
+def bench_checksum_crc(checksum, payloads):
+    for payload in payloads:
+        checksum.crc(payload)
+
+def bench_checksum_digest(checksum, payloads):
+    for payload in payloads:
+        checksum.crc(payload)
+        checksum.update(payload)
+
+# Benchmark the cost per packet of the integrity checks, on memoryview payloads like the ones FileSource hands out.
+# The loop without checks is the baseline, the difference to it is what the checks add to every packet.
+def run_checksum_benchmark(count):
+    print("Integrity checks (memoryview payloads)")
+    view = memoryview(os.urandom(drtp.PACKET_DATA_SIZE * 64))
+    payloads = [view[(i % 64) * drtp.PACKET_DATA_SIZE:(i % 64 + 1) * drtp.PACKET_DATA_SIZE] for i in range(count)]
+    start_time = time.perf_counter()
+    bench_checksum_none(drtp.Checksum(), payloads)
+    baseline = time.perf_counter() - start_time
+    for name, bench in (('CRC32', bench_checksum_crc), ('CRC32 + SHA-256 digest', bench_checksum_digest)):
+        start_time = time.perf_counter()
+        bench(drtp.Checksum(), payloads)
+        duration = time.perf_counter() - start_time
+        report(name, count, duration)
+        print(f"{'':<40} {(duration - baseline) / count * 1e6:>12.2f} us/packet added")
+
+# Decoding a datagram the way receive_packet used to: unpack with the format string, then a dict with a copied payload
+def decode_dict(data):
+    header = struct.unpack(drtp_codec.HEADER_FORMAT, data[:12])
+    return {'seq': header[0], 'ack': header[1], 'flags': header[2], 'window': header[3], 'data': data[12:]}
+
+def bench_decode_dict(datagrams, keep):
+    for data in datagrams:
+        keep.append(decode_dict(data))
+
+# Decoding a datagram into a __slots__ Packet with the precompiled codec
+def bench_decode_packet(datagrams, keep):
+    decode = drtp_codec.Packet.decode
+    for data in datagrams:
+        keep.append(decode(data))
+
+# Encoding a packet the way send_packet used to: read the dict keys back and pack with the format string
+def bench_encode_dict(packets):
+    for packet in packets:
+        struct.pack(drtp_codec.HEADER_FORMAT, packet['seq'], packet['ack'], packet['flags'], packet['window']) + packet['data']
+
+def bench_encode_packet(packets):
+    for packet in packets:
+        packet.encode()
+
+# Headers of one window of sequence numbers, one pack_into per header or the whole window in one call
+def bench_batch_loop(windows):
+    pack_into = drtp_codec.HEADER_STRUCT.pack_into
+    for seqs in windows:
+        buffer = bytearray(len(seqs) * drtp_codec.HEADER_SIZE)
+        for i, seq in enumerate(seqs):
+            pack_into(buffer, i * drtp_codec.HEADER_SIZE, 0, seq, 0, 0)
+        [seq for _, seq, _, _ in drtp_codec.HEADER_STRUCT.iter_unpack(buffer)]
+
+def bench_batch_codec(windows):
+    for seqs in windows:
+        drtp_codec.decode_batch(drtp_codec.encode_batch(seqs))
+
+# Benchmark the packet codec: decoding and encoding with the dict the old helpers used against the __slots__
+# Packet, with the allocations every decoded packet keeps alive, and per-header against batch codecs
+def run_codec_benchmark(count):
+    print("Packet codec")
+    datagrams = [drtp.create_packet(0, seq, 0, 0, PAYLOAD) for seq in range(min(count, 100000))]
+    for name, bench in (('decode: struct.unpack + dict', bench_decode_dict), ('decode: Packet.decode', bench_decode_packet)):
+        start_time = time.perf_counter()
+        bench(datagrams, [])
+        report(name, len(datagrams), time.perf_counter() - start_time)
+
+        # Count what a decoded packet keeps alive on a shorter run, tracemalloc slows every allocation down
+        samples = datagrams[:10000]
+        keep = []
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        bench(samples, keep)
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        size = sum(stat.size_diff for stat in after.compare_to(before, 'filename')) / len(samples)
+        print(f"{'':<40} {size:>12.0f} bytes/packet kept")
+
+    packets = [drtp_codec.Packet.decode(data) for data in datagrams]
+    dicts = [{'seq': p.seq, 'ack': p.ack, 'flags': p.flags, 'window': p.window, 'data': bytes(p.data)} for p in packets]
+    for name, bench, items in (('encode: dict + struct.pack', bench_encode_dict, dicts), ('encode: Packet.encode', bench_encode_packet, packets)):
+        start_time = time.perf_counter()
+        bench(items)
+        report(name, len(items), time.perf_counter() - start_time)
+
+    windows = [list(range(start, start + drtp.MAX_WINDOW)) for start in range(0, count, drtp.MAX_WINDOW)]
+    for name, bench in (('headers: pack_into per header', bench_batch_loop), ('headers: encode_batch/decode_batch', bench_batch_codec)):
+        start_time = time.perf_counter()
+        bench(windows)
+        report(f'{name} ({drtp.MAX_WINDOW})', len(windows) * drtp.MAX_WINDOW, time.perf_counter() - start_time)
+
+# Per-packet event in the send loop: the event of the sent packet and the one of its ACK
+def bench_events(count):
+    for seq in range(count):
+        drtp.event(drtp.EVENT_SEND, seq, "Sent packet with seq: {}")
+        drtp.event(drtp.EVENT_ACK, seq, "Received ack: {}")
+
+# Benchmark the cost of the per-packet events: printed (to /dev/null, a terminal is slower still), counted only
+# with -q, counted and recorded in the event ring with -q --events, and counted and written to a trace with -q --trace
+def run_events_benchmark(count):
+    print("Per-packet events (two per packet)")
+    verbose, ring, trace = drtp.EVENTS.verbose, drtp.EVENTS.ring, drtp.EVENTS.trace
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for name, quiet, size, traced in (('print (stdout to /dev/null)', False, 0, False), ('-q counters', True, 0, False),
+                                              ('-q counters + ring', True, 65536, False), ('-q counters + trace', True, 0, True)):
+                drtp.EVENTS.verbose = not quiet
+                drtp.EVENTS.ring = drtp.EventRing(size) if size else None
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    drtp.EVENTS.trace = drtp.EventTrace(os.path.join(directory, 'trace.bin')) if traced else None
+                    start_time = time.perf_counter()
+                    bench_events(count)
+                    if traced:
+                        drtp.EVENTS.trace.close()  # The last buffered records count as well
+                    duration = time.perf_counter() - start_time
+                report(name, count, duration)
+    finally:
+        drtp.EVENTS.verbose, drtp.EVENTS.ring, drtp.EVENTS.trace = verbose, ring, trace
+
+# UDP forwarder between a DRTP client and server that emulates a slow link.
+# Client packets wait in a drop-tail queue and leave it at the link rate, ACKs from the server go straight back.
+class Bottleneck:
+    def __init__(self, server_address, rate=BOTTLENECK_RATE, queue_size=BOTTLENECK_QUEUE):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.address = self.sock.getsockname()  # Address the client sends to
+        self.server_address = server_address
+        self.client_address = None
+        self.rate = rate
+        self.queue_size = queue_size
+        self.queue = collections.deque()
+        self.ready = threading.Condition()
+        self.closed = False
+        self.arrived = 0  # Packets from the client
+        self.dropped = 0  # Packets dropped because the queue was full
+        self.first = None  # Arrival of the first packet
+        self.last = None  # Departure of the last packet
+        self.threads = [threading.Thread(target=self.receive_loop, daemon=True),
+                        threading.Thread(target=self.link_loop, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def receive_loop(self):
+        while True:
+            try:
+                packet, address = self.sock.recvfrom(2048)
+            except OSError:
+                return  # The forwarder was closed
+            if address == self.server_address:
+                if self.client_address:
+                    self.sock.sendto(packet, self.client_address)
+                continue
+            self.client_address = address
+            with self.ready:
+                self.arrived += 1
+                if self.first is None:
+                    self.first = time.monotonic()
+                if len(self.queue) >= self.queue_size:
+                    self.dropped += 1
+                else:
+                    self.queue.append((time.monotonic(), packet))
+                    self.ready.notify()
+
+    # Send the queued packets one at a time, each taking its size divided by the link rate.
+    # Departures are computed from the arrival times and not from when this thread wakes up, so a late wakeup
+    # does not slow the link down, and a packet stays in the queue until its departure time.
+    def link_loop(self):
+        free = 0.0  # When the link has finished sending the previous packet
+        while True:
+            with self.ready:
+                while not self.queue and not self.closed:
+                    self.ready.wait()
+                if self.closed:
+                    return
+                arrival, packet = self.queue[0]
+            free = max(free, arrival) + len(packet) * 8 / self.rate
+            delay = free - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            with self.ready:
+                self.queue.popleft()
+            self.sock.sendto(packet, self.server_address)
+            self.last = time.monotonic()
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+        self.sock.close()
+
+# Function to find a free UDP port on loopback
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+# Function to transfer file_name through a bottleneck with the DRTP server and client in subprocesses.
+# Returns the goodput in Mbps and the share of packets dropped at the bottleneck.
+def bottleneck_transfer(file_name, protocol, client_args):
+    with tempfile.TemporaryDirectory() as directory:
+        port = free_port()
+        server = subprocess.Popen([sys.executable, APPLICATION, '-s', '-i', '127.0.0.1', '-p', str(port), '-r', protocol,
+                                   '-w', str(drtp.MAX_WINDOW)], cwd=directory, stdout=subprocess.DEVNULL)
+        time.sleep(0.5)  # Let the server bind its socket
+        link = Bottleneck(('127.0.0.1', port))
+        try:
+            subprocess.run([sys.executable, APPLICATION, '-c', '-i', '127.0.0.1', '-p', str(link.address[1]), '-r', protocol,
+                            '-f', file_name, '-w', str(drtp.MAX_WINDOW)] + client_args, stdout=subprocess.DEVNULL, timeout=120)
+            server.wait(timeout=drtp.IDLE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            return None  # The transfer did not finish
+        finally:
+            server.kill()
+            link.close()
+    duration = link.last - link.first
+    return os.path.getsize(file_name) * 8 / duration / 1000000, link.dropped / link.arrived
+
+# Sender settings compared by the pacing benchmark. The fixed window is the largest one, which is more than the
+# queue holds, so only a rate below the link rate keeps it from overflowing the queue. Reno finds the window
+# itself and the estimated rate spreads each window over the RTT.
+PACING_CASES = (
+    ('fixed window', []),
+    (f'fixed window, pacing {BOTTLENECK_RATE * 0.9 / 1000000:.0f} Mbps', ['--pace', str(BOTTLENECK_RATE * 0.9 / 1000000)]),
+    ('reno', ['--cc', 'reno']),
+    ('reno, pacing auto', ['--cc', 'reno', '--pace', 'auto']),
+)
+
+# Benchmark goodput and loss through a 20 Mbps link with a 33 packet queue, with and without pacing
+def run_pacing_benchmark(count):
+    packets = min(count, PACING_PACKETS)
+    print(f"Pacing through a {BOTTLENECK_RATE / 1000000:.0f} Mbps bottleneck with a {BOTTLENECK_QUEUE} packet queue ({packets} packets)")
+    with tempfile.NamedTemporaryFile(suffix='.bin') as f:
+        f.write(os.urandom(packets * drtp.PACKET_DATA_SIZE))
+        f.flush()
+        for protocol in ('GBN', 'SR'):
+            for name, client_args in PACING_CASES:
+                result = bottleneck_transfer(f.name, protocol, client_args)
+                if result is None:
+                    print(f"{protocol + ', ' + name:<40} {'did not finish':>12}")
+                    continue
+                goodput, loss = result
+                print(f"{protocol + ', ' + name:<40} {goodput:>12.2f} Mbps goodput {loss * 100:>6.2f} % dropped")
+
+# Function to run a command and return its exit status and its peak resident set size in bytes
+def run_measured(command, **kwargs):
+    process = subprocess.Popen(command, **kwargs)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)  # Already reaped, keep Popen from waiting again
+    return process.returncode, usage.ru_maxrss * 1024  # ru_maxrss is in kilobytes on Linux
+
+# Benchmark the peak RSS of the sender and the receiver transferring a large file on loopback.
+# The file is many times MEMORY_BOUND, so memory that grows with the file shows up as a failed bound.
+# Returns False when a peak is over the bound.
+def run_memory_benchmark(count):
+    packets = max(count, MEMORY_PACKETS)
+    print(f"Peak RSS transferring {packets * drtp.PACKET_DATA_SIZE / 1024 / 1024:.0f} MB, bound {MEMORY_BOUND / 1024 / 1024:.0f} MB")
+    within_bound = True
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, 'large.bin')
+        with open(file_name, 'wb') as f:
+            block = os.urandom(1024 * drtp.PACKET_DATA_SIZE)
+            for _ in range(packets // 1024):
+                f.write(block)
+            f.write(block[:packets % 1024 * drtp.PACKET_DATA_SIZE])
+        for protocol in ('GBN', 'SR'):
+            port = free_port()
+            server = threading.Thread(target=lambda: results.append(run_measured(
+                [sys.executable, APPLICATION, '-s', '-i', '127.0.0.1', '-p', str(port), '-r', protocol, '-w', str(drtp.MAX_WINDOW)],
+                cwd=directory, stdout=subprocess.DEVNULL)))
+            results = []
+            server.start()
+            time.sleep(0.5)  # Let the server bind its socket
+            client = run_measured([sys.executable, APPLICATION, '-c', '-i', '127.0.0.1', '-p', str(port), '-r', protocol,
+                                   '-f', file_name, '-w', str(drtp.MAX_WINDOW)], stdout=subprocess.DEVNULL)
+            server.join()
+            for side, (status, peak) in (('sender', client), ('receiver', results[0])):
+                verdict = 'ok' if status == 0 and peak < MEMORY_BOUND else 'OVER BOUND' if status == 0 else 'FAILED'
+                within_bound = within_bound and verdict == 'ok'
+                print(f"{protocol + ' ' + side:<40} {peak / 1024 / 1024:>12.1f} MB peak RSS  {verdict}")
+            os.remove(os.path.join(directory, 'received_file.bin'))
+    return within_bound
+
+# Available benchmarks by name
+BENCHMARKS = {
+    'send': run_send_benchmark,
+    'recv': run_recv_benchmark,
+    'codec': run_codec_benchmark,
+    'checksum': run_checksum_benchmark,
+    'events': run_events_benchmark,
+    'pacing': run_pacing_benchmark,
+    'memory': run_memory_benchmark,
+}
+
+def main():
+    # Create a command-line argument parser
+    parser = argparse.ArgumentParser(description='DRTP microbenchmarks')
+    parser.add_argument('-b', type=str, choices=list(BENCHMARKS), action='append', help='Benchmark to run (default: all)')
+    parser.add_argument('-n', type=int, default=PACKET_COUNT, help='Number of packets per benchmark')
+    args = parser.parse_args()
+
+    # Run the selected benchmarks in the order they are defined, a benchmark that checks a bound returns False when it is missed
+    failed = False
+    for name, bench in BENCHMARKS.items():
+        if not args.b or name in args.b:
+            failed = bench(args.n) is False or failed
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+import argparse
+import csv
+import filecmp
+import itertools
+import os
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import application1 as drtp
+from benchmark import APPLICATION, free_port
+
+# Points swept by default: every protocol, the default window, a small and a large file, no loss and 1 % loss,
+# and loopback and a 20 ms RTT
+PROTOCOLS = ['stop_and_wait', 'GBN', 'SR']
+WINDOWS = [drtp.DEFAULT_WINDOW]
+SIZES = [100 * 1024, 1024 * 1024]
+LOSSES = [0.0, 0.01]
+RTTS = [0.0, 20.0]
+REPEATS = 3
+
+# Longest a transfer may take before it counts as failed, in seconds
+RUN_TIMEOUT = 120
+
+# Regression threshold of --compare, in percent
+THRESHOLD = 10.0
+
+# Columns of the result CSV. The first five describe the point, repeat numbers the runs of a point.
+FIELDS = ['protocol', 'window', 'file_size', 'loss', 'rtt_ms', 'repeat', 'status', 'goodput_mbps', 'retransmissions',
+          'duration_s', 'client_cpu_s', 'server_cpu_s']
+POINT_FIELDS = FIELDS[:5]
+
+# Function to parse a file size with an optional K or M suffix
+def file_size(value):
+    units = {'K': 1024, 'M': 1024 * 1024}
+    if value[-1:].upper() in units:
+        return int(float(value[:-1]) * units[value[-1:].upper()])
+    return int(value)
+
+# Function to parse a comma-separated list with the parser of one item
+def listed(parse):
+    return lambda value: [parse(item) for item in value.split(',')]
+
+# Function to wait for a process until a deadline, returns its exit status, None if it had to be killed, and the
+# CPU time it used in seconds
+def wait_cpu(process, deadline):
+    status = None
+    while True:
+        pid, waited, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            status = os.waitstatus_to_exitcode(waited)
+            break
+        if time.monotonic() > deadline:
+            process.kill()
+            _, _, usage = os.wait4(process.pid, 0)
+            break
+        time.sleep(0.01)
+    process.returncode = -9 if status is None else status  # Already reaped, keep Popen from waiting again
+    return status, usage.ru_utime + usage.ru_stime
+
+# Function to read the duration of the data transfer and the retransmissions from a client trace: from the
+# first event to the last, and every packet resent after a timeout or by fast retransmit
+def read_trace(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    size = drtp.EVENT_STRUCT.size
+    body = data[drtp.EVENT_HEADER.size:]
+    records = list(drtp.EVENT_STRUCT.iter_unpack(body[:len(body) - len(body) % size]))
+    if not records:
+        return 0.0, 0
+    retransmissions = sum(1 for _, kind, _, _ in records if kind in (drtp.EVENT_RESEND, drtp.EVENT_FAST_RETRANSMIT))
+    return (records[-1][0] - records[0][0]) / 1e9, retransmissions
+
+# Function to transfer one file on loopback with the server and the client in subprocesses. Loss is applied to
+# the data packets and the RTT is split between the two directions, both through the -t impairment, seeded by
+# the repeat so every repeat sees other losses and a rerun sees the same ones. Returns a result row.
+def run_point(directory, file_name, protocol, window, loss, rtt, repeat, client_args, server_args, timeout):
+    port = free_port()
+    delay = f'delay={rtt / 2:g}'
+    server_command = [sys.executable, APPLICATION, '-s', '-i', '127.0.0.1', '-p', str(port), '-r', protocol, '-q',
+                      '-w', str(window)] + (['-t', delay] if rtt else []) + server_args
+    trace = os.path.join(directory, 'client.trace')
+    client_command = [sys.executable, APPLICATION, '-c', '-i', '127.0.0.1', '-p', str(port), '-r', protocol, '-q',
+                      '-w', str(window), '-f', file_name, '--trace', trace] + client_args
+    impairment = [f'loss={loss:g}'] if loss else []
+    if rtt:
+        impairment.append(delay)
+    if impairment:
+        client_command += ['-t', ','.join(impairment + [f'seed={repeat + 1}'])]
+
+    row = {'status': 'failed', 'goodput_mbps': '', 'retransmissions': '', 'duration_s': '', 'client_cpu_s': '', 'server_cpu_s': ''}
+    server = subprocess.Popen(server_command, cwd=directory, stdout=subprocess.DEVNULL)
+    time.sleep(0.5)  # Let the server bind its socket
+    client = subprocess.Popen(client_command, cwd=directory, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    client_status, client_cpu = wait_cpu(client, deadline)
+    # The server finishes right after the client, or waits for packets that will never come when the client was killed
+    server_status, server_cpu = wait_cpu(server, time.monotonic() + drtp.IDLE_TIMEOUT if client_status is not None else 0)
+    row['client_cpu_s'] = f'{client_cpu:.3f}'
+    row['server_cpu_s'] = f'{server_cpu:.3f}'
+
+    received = [name for name in os.listdir(directory) if name.startswith('received_file')]
+    if client_status is None or server_status is None:
+        row['status'] = 'timeout'
+    elif client_status == 0 and server_status == 0 and received and filecmp.cmp(os.path.join(directory, received[0]), file_name, shallow=False):
+        duration, retransmissions = read_trace(trace)
+        row['status'] = 'ok'
+        row['duration_s'] = f'{duration:.4f}'
+        row['retransmissions'] = retransmissions
+        row['goodput_mbps'] = f'{os.path.getsize(file_name) * 8 / duration / 1000000:.3f}' if duration else ''
+    for name in received + ['client.trace']:
+        if os.path.exists(os.path.join(directory, name)):
+            os.remove(os.path.join(directory, name))
+    return row
+
+# Function to sweep every point of the matrix, repeats times each, and write a row per run to output as it finishes
+def run_matrix(args):
+    client_args = shlex.split(args.client_args)
+    server_args = shlex.split(args.server_args)
+    with tempfile.TemporaryDirectory() as directory, open(args.o, 'w', newline='') as output:
+        writer = csv.DictWriter(output, fieldnames=FIELDS)
+        writer.writeheader()
+        files = {}
+        for size in args.sizes:
+            files[size] = os.path.join(directory, f'file_{size}.bin')
+            with open(files[size], 'wb') as f:
+                f.write(os.urandom(size))  # Random data, so --compress in the client arguments cannot shrink it
+
+        # Stop-and-wait has no window, so it is run once per file size, loss and RTT
+        points = []
+        for protocol, window, size, loss, rtt in itertools.product(args.r, args.w, args.sizes, args.loss, args.rtt):
+            point = (protocol, 1 if protocol == 'stop_and_wait' else window, size, loss, rtt)
+            if point not in points:
+                points.append(point)
+
+        for number, (protocol, window, size, loss, rtt) in enumerate(points, 1):
+            for repeat in range(args.repeats):
+                row = run_point(directory, files[size], protocol, window, loss, rtt, repeat, client_args, server_args, args.timeout)
+                row.update(protocol=protocol, window=window, file_size=size, loss=loss, rtt_ms=rtt, repeat=repeat)
+                writer.writerow(row)
+                output.flush()  # A sweep that is stopped keeps the rows it has
+                print(f"[{number}/{len(points)}] {protocol:<13} window {window:>2} {size:>9} bytes loss {loss:<5g} RTT {rtt:>5g} ms "
+                      f"repeat {repeat}: {row['status']:<7} {row['goodput_mbps'] or '-':>9} Mbps, "
+                      f"{row['retransmissions'] if row['retransmissions'] != '' else '-'} retransmissions")
+    print(f"Results written to {args.o}")
+
+# Function to read a result CSV into the median goodput and CPU time of every point, over its successful runs
+def load_results(path):
+    runs = {}
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            point = tuple(row[field] for field in POINT_FIELDS)
+            runs.setdefault(point, [])
+            if row['status'] == 'ok' and row['goodput_mbps']:
+                runs[point].append((float(row['goodput_mbps']), float(row['client_cpu_s']) + float(row['server_cpu_s'])))
+    return {point: (statistics.median(goodput for goodput, _ in results), statistics.median(cpu for _, cpu in results)) if results else None
+            for point, results in runs.items()}
+
+# Function to compare the points two result files have in common. A point regresses when its median goodput
+# fell or its median CPU time rose by more than threshold percent, or when it no longer completes.
+# Returns the number of regressions.
+def compare(old_path, new_path, threshold):
+    old, new = load_results(old_path), load_results(new_path)
+    regressions = 0
+    print(f"{'point':<52} {'goodput Mbps':>21} {'CPU s':>17}")
+    for point in [point for point in old if point in new]:
+        name = f"{point[0]} w{point[1]} {point[2]} B loss {point[3]} RTT {point[4]} ms"
+        if old[point] is None or new[point] is None:
+            flag = 'REGRESSION' if new[point] is None and old[point] is not None else ''
+            regressions += bool(flag)
+            print(f"{name:<52} {'no successful runs in ' + ('the new' if new[point] is None else 'the old') + ' results':>39} {flag}")
+            continue
+        (old_goodput, old_cpu), (new_goodput, new_cpu) = old[point], new[point]
+        goodput_change = (new_goodput - old_goodput) / old_goodput * 100 if old_goodput else 0.0
+        cpu_change = (new_cpu - old_cpu) / old_cpu * 100 if old_cpu else 0.0
+        flags = []
+        if goodput_change < -threshold:
+            flags.append('goodput')
+        if cpu_change > threshold:
+            flags.append('CPU')
+        regressions += bool(flags)
+        print(f"{name:<52} {old_goodput:>7.2f} -> {new_goodput:>7.2f} {goodput_change:>+6.1f}% "
+              f"{old_cpu:>5.2f} -> {new_cpu:>5.2f} {cpu_change:>+6.1f}%  {'REGRESSION: ' + ', '.join(flags) if flags else ''}")
+    print(f"{regressions} regressions above {threshold:g} %")
+    return regressions
+
+def main():
+    # Create a command-line argument parser
+    parser = argparse.ArgumentParser(description='Sweep DRTP transfers on loopback and write the results as CSV, or compare two result files')
+    parser.add_argument('-r', type=listed(str), default=PROTOCOLS, help='Protocols, comma-separated')
+    parser.add_argument('-w', type=listed(int), default=WINDOWS, help='GBN/SR windows in packets, comma-separated')
+    parser.add_argument('--sizes', type=listed(file_size), default=SIZES, help='File sizes in bytes, K or M, comma-separated')
+    parser.add_argument('--loss', type=listed(float), default=LOSSES, help='Loss rates of the data packets, comma-separated')
+    parser.add_argument('--rtt', type=listed(float), default=RTTS, help='Emulated RTTs in ms, comma-separated')
+    parser.add_argument('--repeats', type=int, default=REPEATS, help='Runs of every point')
+    parser.add_argument('--timeout', type=float, default=RUN_TIMEOUT, help='Seconds a transfer may take before it counts as failed')
+    parser.add_argument('--client-args', type=str, default='', help='Extra client arguments, such as "--cc reno --sack"')
+    parser.add_argument('--server-args', type=str, default='', help='Extra server arguments')
+    parser.add_argument('-o', type=str, default='drtp_matrix.csv', help='Result CSV file')
+    parser.add_argument('--compare', type=str, nargs=2, metavar=('OLD', 'NEW'), help='Compare two result files instead of running')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help='Change in percent that counts as a regression')
+    args = parser.parse_args()
+
+    if args.compare:
+        if compare(*args.compare, args.threshold):
+            sys.exit(1)
+        return
+
+    for protocol in args.r:
+        if protocol not in PROTOCOLS:
+            parser.error(f"Unknown protocol {protocol}, choose from {', '.join(PROTOCOLS)}")
+    if not all(1 <= window <= drtp.MAX_WINDOW for window in args.w):
+        parser.error(f"The windows must be within the range [1, {drtp.MAX_WINDOW}]")
+    if not all(0 <= loss < 1 for loss in args.loss) or not all(rtt >= 0 for rtt in args.rtt):
+        parser.error("Loss rates must be within [0, 1) and RTTs cannot be negative")
+    if args.repeats < 1:
+        parser.error("Every point needs at least one run")
+    run_matrix(args)
+
+if __name__ == "__main__":
+    main()